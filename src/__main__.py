@@ -1,15 +1,104 @@
 from analysis.sql import SqlAnalyzer
-from parsers import get_parser_result
+from parsers import get_parser_result, find_sheets, sheet_names
 from printers import get_printer
-from containers import Student
+from containers import Student, ParserOptions, StatisticsBook, StatisticsSheet, SheetCombiner
 from pathlib import Path
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+import profiling
 
-def getStudents(file: Path, answer_count: int) -> list[Student]:
+def getStudents(file: Path, answer_count: int, options: Optional[ParserOptions]=None) -> list[Student]:
 	file = Path(file)
-	return get_parser_result([file, str(answer_count)])
+	return get_parser_result([file, str(answer_count), options])
+
+def parseSheets(files: list[Path], answer_count: int, options: ParserOptions) -> list[list[Student]]:
+	"""
+	Parses several files at once. Their pages are scheduled on the same worker processes.
+	Reports progress and throughput after every file
+	"""
+	jobs = options.worker_count()
+	results: list[list[Student]] = [[] for _ in files]
+	sheet_count = 0
+	start = time.perf_counter()
+
+	with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(files)))) as executor:
+		futures = {executor.submit(getStudents, file, answer_count, options): index for index, file in enumerate(files)}
+		for done, future in enumerate(as_completed(futures), start=1):
+			index = futures[future]
+			students = future.result()
+			if students is None:
+				raise ValueError(f"No parser for '{files[index]}'")
+			results[index] = students
+			sheet_count += len(students)
+			elapsed = time.perf_counter() - start
+			print(f"[{done}/{len(files)}] {files[index]}: {len(students)} sheets ({sheet_count / elapsed:.1f} sheets/s)")
+
+	if options.cache is not None:
+		from store import PageCache
+		print(f"Cache: {PageCache.TOTAL_HITS} hits, {PageCache.TOTAL_MISSES} misses in total")
+	return results
+
+def combineSheets(files: list[Path], results: list[list[Student]], nerd: Optional[Student]=None) -> tuple[list[Student], StatisticsSheet]:
+	"""
+	Students of all files in one list. Ids of later files are moved behind those of earlier files if they overlap,
+	and sheets don't keep the id of the solution. The returned sheet maps every id to its file
+	"""
+	combiner = SheetCombiner(nerd.id if nerd is not None else None)
+	for file, file_students in zip(files, results):
+		combiner.add(file, file_students)
+		combiner.end_file()
+	return combiner.students, combiner.sources
+
+def analyzeStudents(students: list[Student], nerd: Optional[Student], args: Namespace, database: Optional[Path]=None) -> StatisticsBook:
+	""" Reports of the students. The SQL tables are kept in `database`, or in a database of this analysis only """
+	if args.native:
+		# NumPy is only needed here
+		from analysis.native import NativeAnalyzer
+		statistics = NativeAnalyzer(students, nerd=nerd)
+		book = statistics.analyze()
+		if args.sql is not None:
+			# Custom queries on top of the standard reports
+			book.sheets.extend(SqlAnalyzer(students, nerd=nerd, sql_path=args.sql, jobs=args.jobs, database=database, stream=args.stream).analyze().sheets)
+	else:
+		statistics = SqlAnalyzer(students, nerd=nerd, sql_path=args.sql or Path('./'), jobs=args.jobs, database=database, stream=args.stream)
+		book = statistics.analyze()
+	return book
+
+def pipelineSheets(files: list[Path], nerd: Optional[Student], args: Namespace, options: ParserOptions) -> StatisticsBook:
+	""" Parses all files and loads them into SQL in one pipeline, see `pipeline.Pipeline` """
+	from pipeline import Pipeline
+
+	sql_path = None if args.native else args.sql or Path('./')
+	pipeline = Pipeline(files, args.count, options, nerd=nerd, sql_path=sql_path, stream=args.stream)
+	book = pipeline.run()
+	if args.native:
+		book = analyzeStudents(pipeline.students, nerd, args)
+	if len(files) > 1:
+		book.sheets.append(pipeline.sources)
+	return book
+
+def serve(args: Namespace, nerd: Optional[Student], options: ParserOptions):
+	""" Service mode. Worker processes are started once and stay ready for all files """
+	from parsers.pdf import warm_up
+	from service import WatchService
+
+	jobs = options.worker_count()
+	if jobs > 1:
+		warm_up(jobs)
+
+	def process(file: Path) -> StatisticsBook:
+		students = getStudents(file, args.count, options)
+		if students is None:
+			raise ValueError(f"No parser for '{file}'")
+		(students, _) = combineSheets([file], [students], nerd)
+		# Jobs run at the same time, and the analysis recreates its tables. `--store` only shares the parsed pages
+		return analyzeStudents(students, nerd, args)
+
+	service = WatchService(args.watch, args.output, process, workers=jobs, interval=args.poll, max_queue=args.max_queue)
+	service.serve()
 
 def main():
 	print("Running...")
@@ -18,27 +107,72 @@ def main():
 		prog="src",
 		description="Analyze exam sheets"
 	)
-	argparser.add_argument('sheets', type=Path, help="The sheets to analyze")
+	argparser.add_argument('sheets', nargs='*', help="The sheets to analyze. Files, directories or glob patterns")
 	argparser.add_argument('-s', '--solution', type=Path, default=None, help="Solutions for use in analysis")
 	argparser.add_argument('-sid', '--solution-id', type=int, default=0, help="The id for the solution sheet 'student' (Default: 0)")
 	argparser.add_argument('-o', '--output', type=Path, required=True, help="The path/file where the analysis will be outputted")
-	argparser.add_argument('-q', '--sql', type=Path, default=Path('./'), help="File or directory of sql queries (Default: ./)")
+	argparser.add_argument('--per-file', action='store_true', help="Analyze every sheet file on its own and write one output per file")
+	argparser.add_argument('-w', '--watch', type=Path, default=None, help="Keep running and analyze every sheet file that lands in this directory, one output per file")
+	argparser.add_argument('--poll', type=float, default=1.0, help="Seconds between checks of the --watch directory (Default: 1)")
+	argparser.add_argument('--max-queue', type=int, default=16, help="Maximum amount of queued files in --watch mode, more files wait in the directory (Default: 16)")
+	argparser.add_argument('-q', '--sql', type=Path, default=None, help="File or directory of sql queries (Default: ./, none with --native)")
+	argparser.add_argument('-n', '--native', action='store_true', help="Compute the standard reports without SQL. Queries are only run if --sql is given")
+	argparser.add_argument('--stream', action='store_true', help="Run queries while writing the output instead of collecting all results first")
 	argparser.add_argument('-c', '--count', type=int, default=4, help="Amount of possible answers per question (Default: 4)")
+	argparser.add_argument('-t', '--template', action='store_true', help="Detect the checkbox grid once (from the solution or the first clean sheet) and reuse it for all sheets")
+	argparser.add_argument('--store', type=Path, default=None, help="SQLite file that keeps parsed pages and the results between runs. Only new or changed pages are parsed. With --watch, only the pages are kept")
+	argparser.add_argument('--cache', type=Path, default=None, help="Directory that keeps the results of pages by content, shared between files and runs")
+	argparser.add_argument('--cache-size', type=int, default=256, help="Size in MB up to which the cache directory may grow (Default: 256)")
+	argparser.add_argument('--raster-files', action='store_true', help="Rasterize PDF pages into uncompressed temporary files that the workers map into memory, instead of passing decoded pages to them")
+	argparser.add_argument('--pipeline', action='store_true', help="Overlap rasterizing, analyzing pages and loading them into SQL instead of running one step after the other")
+	argparser.add_argument('-j', '--jobs', type=int, default=1, help="Amount of worker processes for analyzing pages and threads for running queries, 0 uses all cores (Default: 1)")
+	argparser.add_argument('--profile', type=Path, default=None, help="Write the time of every stage and counters of pages and boxes to this .json or .csv file")
+	argparser.add_argument('--cprofile', type=Path, default=None, help="Write cProfile statistics of the main process to this file")
 	args = argparser.parse_args()
+	if args.pipeline and (args.per_file or args.watch or args.store or args.cache or args.raster_files):
+		argparser.error("--pipeline can't be combined with --per-file, --watch, --store, --cache or --raster-files")
+	if args.template and (args.store or args.cache):
+		# Pages of a template run depend on the layout found before them, a stored page is only valid for its own run
+		argparser.error("--template can't be combined with --store or --cache")
+
+	if args.profile is not None:
+		profiling.enable()
+	profiler = None
+	if args.cprofile is not None:
+		import cProfile
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+	try:
+		run(args)
+	finally:
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(args.cprofile)
+		if args.profile is not None:
+			profiling.write(args.profile)
+
+	print("Finished!")
+
+def run(args: Namespace):
 	# STEP 1 : Get locations
 
-	sheetsPath = args.sheets
+	sheetPaths = find_sheets(args.sheets)
+	if len(sheetPaths) == 0 and args.watch is None:
+		raise ValueError("No sheets found")
 	solutionPath = args.solution
 	outputPath = args.output
+	options = ParserOptions(jobs=args.jobs, template=args.template, store=args.store,
+		cache=args.cache, cache_size=args.cache_size * 1024 * 1024, raster_files=args.raster_files)
 
-	# STEP 2 : Read sheets & solutions
-
-	students = getStudents(sheetsPath, args.count)
+	# STEP 2 : Read solutions & sheets
+	# The solution comes first, it is the preferred source for the layout template
 
 	# Has all answers correct, what a nerd!
 	nerd: Optional[Student]
 	if solutionPath is not None:
-		nerd = getStudents(solutionPath, args.count)
+		with profiling.span("main.solution"):
+			nerd = getStudents(solutionPath, args.count, options)
 		if len(nerd) > 1:
 			raise ValueError() # TODO proper error handling
 		nerd = nerd[0] if len(nerd) > 0 else None
@@ -47,17 +181,41 @@ def main():
 	else:
 		nerd = None
 
-	# STEP 3 : Analyze...
+	if args.watch is not None:
+		serve(args, nerd, options)
+		return
 
-	statistics = SqlAnalyzer(students, nerd=nerd, sql_path=args.sql)
-	book = statistics.analyze()
+	if args.pipeline:
+		with profiling.span("main.pipeline"):
+			book = pipelineSheets(sheetPaths, nerd, args, options)
+		with profiling.span("main.print"):
+			printer = get_printer(outputPath, book=book)
+			printer.printStatistics()
+		return
 
-	# STEP 4 : Print results
+	with profiling.span("main.sheets"):
+		results = parseSheets(sheetPaths, args.count, options)
 
-	printer = get_printer(outputPath, book=book)
-	printer.printStatistics()
+	# STEP 3 : Analyze...
+	# STEP 4 : Print results
 
-	print("Finished!")
+	if args.per_file:
+		for sheetPath, sheetName, students in zip(sheetPaths, sheet_names(sheetPaths), results):
+			with profiling.span("main.analyze"):
+				(students, _) = combineSheets([sheetPath], [students], nerd)
+				book = analyzeStudents(students, nerd, args, database=args.store)
+			with profiling.span("main.print"):
+				printer = get_printer(outputPath.with_name(f"{outputPath.stem}_{sheetName}{outputPath.suffix}"), book=book)
+				printer.printStatistics()
+	else:
+		with profiling.span("main.analyze"):
+			students, sources = combineSheets(sheetPaths, results, nerd)
+			book = analyzeStudents(students, nerd, args, database=args.store)
+			if len(sheetPaths) > 1:
+				book.sheets.append(sources)
+		with profiling.span("main.print"):
+			printer = get_printer(outputPath, book=book)
+			printer.printStatistics()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+from containers import StatisticsBook, StatisticsSheet, StatisticsRow, Student
+from interfaces import AnswerStatistics
+from matrix import AnswerMatrix, StudentView, encode
+from typing import Optional
+
+import numpy
+
+class NativeAnalyzer(AnswerStatistics):
+	"""
+	Computes the reports shipped in `sql_queries/` with array operations instead of SQL.
+	Produces the same sheets for any amount of checkboxes per question
+	"""
+
+	# Share of correct answers a question needs to be concidered easy/moderate. Values (easy, moderate)
+	DIFFICULTY_THRESHOLDS = (0.80, 0.45)
+
+	def __init__(self, students: list[Student], nerd: Optional[Student]) -> None:
+		super().__init__(students=students, nerd=nerd)
+
+		# Students from a parser are often views on a single matrix already
+		if len(students) > 0 and all(isinstance(student, StudentView) for student in students) \
+				and all(student.matrix is students[0].matrix for student in students):
+			self.matrix = students[0].matrix
+			self.rows = numpy.array([student.index for student in students], dtype=numpy.int64)
+		else:
+			self.matrix = AnswerMatrix.from_students(students)
+			self.rows = numpy.arange(len(students))
+
+	def analyze(self) -> StatisticsBook:
+		self.prepare()
+		return StatisticsBook(sheets=[
+			self.all_data(),
+			self.class_average(),
+			self.question_performance(),
+			self.results_easy_read(),
+			self.student_scores(),
+		])
+
+	def prepare(self):
+		""" Evaluates every question of every student (the nerd first) against the nerd """
+		nerd_codes = encode([answer.options for answer in self.nerd.answers]) if self.nerd is not None else numpy.zeros((0, 0), numpy.uint8)
+		student_codes = self.matrix.codes[self.rows]
+		student_questions = self.matrix.question_counts()[self.rows]
+
+		questions = max(student_codes.shape[1], nerd_codes.shape[0])
+		boxes = max(student_codes.shape[2], nerd_codes.shape[1])
+		codes = numpy.zeros((len(self.rows) + 1, questions, boxes), dtype=numpy.uint8)
+		codes[0, :nerd_codes.shape[0], :nerd_codes.shape[1]] = nerd_codes
+		codes[1:, :student_codes.shape[1], :student_codes.shape[2]] = student_codes
+
+		self.codes = codes
+		self.ids = numpy.concatenate(([self.nerd.id if self.nerd is not None else 0], [student.id for student in self.students])).astype(numpy.int64)
+		self.question_counts = numpy.concatenate(([nerd_codes.shape[0]], student_questions))
+
+		# A question is evaluated if the student has it and the nerd has an answer for it
+		self.present = numpy.arange(questions)[numpy.newaxis, :] < numpy.minimum(self.question_counts, nerd_codes.shape[0])[:, numpy.newaxis]
+		if self.nerd is None:
+			self.present[0] = False
+
+		# Correct if any box is selected by both, the student and the nerd
+		selected = (codes == ord('X')) | (codes == ord('x'))
+		self.correct = (selected & selected[0]).any(axis=2) & self.present
+		# Like the reports, class statistics leave out everyone with the id of the nerd
+		self.is_student = self.ids != self.ids[0] if self.nerd is not None else numpy.ones(len(self.ids), dtype=bool)
+		self.is_student[0] = False
+
+	def all_data(self) -> StatisticsSheet:
+		sheet = StatisticsSheet("all_data")
+		box_count = self.codes.shape[2]
+		sheet.rows.append(StatisticsRow(["id", "question", *(f"box{i}" for i in range(box_count))]))
+
+		first = 0 if self.nerd is not None else 1
+		for row in range(first, len(self.ids)):
+			id = str(self.ids[row])
+			for question in range(self.question_counts[row]):
+				options = self.codes[row, question].tobytes().rstrip(b'\0').decode('ascii')
+				sheet.rows.append(StatisticsRow([id, str(question + 1), *options]))
+		return sheet
+
+	def class_average(self) -> StatisticsSheet:
+		sheet = StatisticsSheet("class_average")
+		sheet.rows.append(StatisticsRow(["Average"]))
+
+		mask = self.present & self.is_student[:, numpy.newaxis]
+		count = int(mask.sum())
+		# Like SQL, the average of nothing is NULL
+		average = float(self.correct[mask].sum()) / count if count > 0 else None
+		sheet.rows.append(StatisticsRow([str(average)]))
+		return sheet
+
+	def question_performance(self) -> StatisticsSheet:
+		sheet = StatisticsSheet("question-performance")
+		sheet.rows.append(StatisticsRow(["question", "correct", "wrong", "difficulty"]))
+
+		mask = self.present & self.is_student[:, numpy.newaxis]
+		answered = mask.sum(axis=0)
+		correct = (self.correct & mask).sum(axis=0)
+		ratio = correct / numpy.maximum(answered, 1)
+		(easy, moderate) = self.DIFFICULTY_THRESHOLDS
+		difficulty = numpy.where(ratio >= easy, "easy", numpy.where(ratio >= moderate, "moderate", "hard"))
+
+		for question in numpy.flatnonzero(answered).tolist():
+			sheet.rows.append(StatisticsRow([
+				str(question + 1),
+				str(int(correct[question])),
+				str(int(answered[question] - correct[question])),
+				str(difficulty[question]),
+			]))
+		return sheet
+
+	def results_easy_read(self) -> StatisticsSheet:
+		sheet = StatisticsSheet("results-easyRead")
+		sheet.rows.append(StatisticsRow(["id", "question", "correct"]))
+
+		# Ordered by question, then by id (ties in order of insertion)
+		(questions, rows) = numpy.nonzero(self.present.T)
+		order = numpy.lexsort((self.ids[rows], questions))
+		(questions, rows) = (questions[order], rows[order])
+		ids = self.ids[rows].tolist()
+		correct = self.correct[rows, questions].astype(numpy.int64).tolist()
+		for id, question, value in zip(ids, (questions + 1).tolist(), correct):
+			sheet.rows.append(StatisticsRow([str(id), str(question), str(value)]))
+		return sheet
+
+	def student_scores(self) -> StatisticsSheet:
+		sheet = StatisticsSheet("student_scores")
+		sheet.rows.append(StatisticsRow(["Student", "Correct", "Average"]))
+
+		answered = self.present.sum(axis=1)
+		has_answers = answered > 0
+		# Grouped by id like GROUP BY, which also sorts
+		(ids, groups) = numpy.unique(self.ids[has_answers], return_inverse=True)
+		correct = numpy.bincount(groups, weights=self.correct.sum(axis=1)[has_answers], minlength=len(ids))
+		count = numpy.bincount(groups, weights=answered[has_answers], minlength=len(ids))
+
+		for id, student_correct, student_count in zip(ids.tolist(), correct.tolist(), count.tolist()):
+			sheet.rows.append(StatisticsRow([str(id), str(int(student_correct)), str(student_correct / student_count)]))
+		return sheet
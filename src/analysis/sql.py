@@ -1,9 +1,15 @@
-from containers import StatisticsBook, StatisticsSheet, StatisticsRow, Student
+from containers import StatisticsBook, StatisticsSheet, StatisticsRow, ColumnarSheet, Student, worker_count
 from interfaces import AnswerStatistics
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from tempfile import TemporaryDirectory
+import itertools
+import os
 
 import sqlite3
+import profiling
 
 example_sql = """
 SELECT id, question, box1 as A
@@ -14,9 +20,28 @@ question1 LIKE question1(WHERE name = "nerd");
 
 
 class SqlAnalyzer(AnswerStatistics):
-	def __init__(self, students: list[Student], nerd: Optional[Student], sql_path: Path) -> None:
+	# Distinguishes the shared in-memory databases of analyzers running at the same time
+	DATABASE_IDS = itertools.count()
+
+	# Amount of rows fetched at once when streaming
+	FETCH_SIZE = 1000
+
+	def __init__(self, students: list[Student], nerd: Optional[Student], sql_path: Path, jobs: int=1, database: Optional[Path]=None, stream: bool=False) -> None:
 		super().__init__(students=students, nerd=nerd)
 		self.sql_path = Path(sql_path)
+		self.jobs = jobs
+		self.stream = stream
+		# Without a database file, the tables only live as long as the analysis
+		self.database = Path(database) if database is not None else None
+		if self.stream and self.database is None:
+			# Streamed sheets are read after the analysis, so the tables have to outlive it.
+			# The directory is removed together with the analyzer
+			self.temp_dir = TemporaryDirectory(prefix="sql_analyzer_")
+			self.database = Path(self.temp_dir.name) / "results.db"
+		if self.database is not None:
+			self.uri = f"{self.database.resolve().as_uri()}?mode=ro"
+		else:
+			self.uri = f"file:sql_analyzer_{os.getpid()}_{next(self.DATABASE_IDS)}?mode=memory&cache=shared"
 		# count checkboxes:
 		if self.nerd is not None:
 			self.box_count = len(self.nerd.answers[0].options)
@@ -25,11 +50,14 @@ class SqlAnalyzer(AnswerStatistics):
 		# print("Total number of boxes:", self.box_count)
 	
 	def analyze(self) -> StatisticsBook:
-		with self.create_connection() as conn:		# does the same as: conn = self.create_connection()
+		with closing(self.create_connection()) as conn:		# does the same as: conn = self.create_connection(), closes it afterwards
 
 			if conn is not None:
-				self.create_table(conn)
-				self.insert_data(conn)
+				with profiling.span("sql.load"):
+					self.create_table(conn)
+					self.insert_data(conn)
+					self.create_correctness(conn)
+					conn.commit()
 				# self.check_tables(conn)
 				return self.execute_sql(conn)
 			else: 
@@ -38,49 +66,55 @@ class SqlAnalyzer(AnswerStatistics):
 	
 
 	def create_connection(self):
-		conn = sqlite3.connect(':memory:')
+		if self.database is not None:
+			conn = sqlite3.connect(self.database)
+		elif self.worker_count() > 1:
+			# Other connections to the same uri see this database as long as this connection is open
+			conn = sqlite3.connect(self.uri, uri=True)
+		else:
+			conn = sqlite3.connect(':memory:')
 		return conn
 
+	def create_reader(self) -> sqlite3.Connection:
+		""" Additional connection to the database of `create_connection()` that rejects writes """
+		conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+		conn.execute("PRAGMA query_only = ON")
+		return conn
+
+	def worker_count(self) -> int:
+		return worker_count(self.jobs)
+
 
 	def create_table(self, conn: sqlite3.Connection):
 		#count number of questions
 
 		boxes = " "
 		for i in range(self.box_count): 
-			boxes += ", box" + str(i)
+			boxes += ", box" + str(i) + " TEXT"
 		# print(boxes)
 
 		cur = conn.cursor()
-		cur.execute(f"CREATE TABLE IF NOT EXISTS results(id int, question int{boxes})")
+		# A database file still contains the tables of the previous analysis
+		for table in ("results", "correctness", "solution"):
+			cur.execute(f"DROP TABLE IF EXISTS {table}")
+		cur.execute(f"CREATE TABLE IF NOT EXISTS results(id INTEGER, question INTEGER{boxes})")
+		cur.execute("CREATE INDEX IF NOT EXISTS results_id_question ON results(id, question)")
 
 	
 	def insert_data(self, conn: sqlite3.Connection):
+		students = self.students if self.nerd is None else [self.nerd, *self.students]
+		self.insert_students(conn, students)
+
+	def insert_students(self, conn: sqlite3.Connection, students: Iterable[Student]):
+		""" Adds the answers of `students` to `results`. Can be called repeatedly while students arrive """
 		cur = conn.cursor()
-		
-		sql_data = []
 
-		if self.nerd is not None:
-			student = self.nerd
-			for iq, question in enumerate(student.answers):
-				sql_params = [
-					student.id,
-					iq+1,
-				]
-				for checkbox in question.options:
-					sql_params.append(checkbox)
-
-				sql_data.append(sql_params)
-
-		for student in self.students:
-			for iq, question in enumerate(student.answers):
-				sql_params = [
-					student.id,
-					iq+1,
-				]
-				for checkbox in question.options:
-					sql_params.append(checkbox)
-
-				sql_data.append(sql_params)
+		# One row per question: id, question number, one value per checkbox
+		sql_data = (
+			(student.id, iq+1, *question.options)
+			for student in students
+			for iq, question in enumerate(student.answers)
+		)
 		
 		boxes = ["?"] * self.box_count
 		boxes = ", ".join(boxes)
@@ -89,6 +123,35 @@ class SqlAnalyzer(AnswerStatistics):
 		cur.executemany(f"INSERT INTO results VALUES (?, ?, {boxes})", sql_data)
 
 
+	def create_correctness(self, conn: sqlite3.Connection):
+		"""
+		Evaluates every answer against the solution once, so queries don't have to join `results` with itself.
+
+		- `solution(id)` contains the id of the solution sheet (if any)
+		- `correctness(id, question, correct, selected_count)` contains one row per answer that has a solution,
+		  including the solution itself. `correct` is 1 if a box selected in the solution is selected
+		"""
+		cur = conn.cursor()
+		cur.execute("CREATE TABLE IF NOT EXISTS solution(id INTEGER)")
+		cur.execute("CREATE TABLE IF NOT EXISTS correctness(id INTEGER, question INTEGER, correct INTEGER, selected_count INTEGER)")
+
+		if self.nerd is None:
+			return
+		cur.execute("INSERT INTO solution VALUES (?)", (self.nerd.id,))
+
+		boxes = [f"box{i}" for i in range(self.box_count)]
+		correct = " OR ".join(f"(st.{box} LIKE nerd.{box} AND st.{box} LIKE 'x')" for box in boxes)
+		selected = " + ".join(f"(st.{box} LIKE 'x')" for box in boxes)
+
+		cur.execute(f"""
+			INSERT INTO correctness
+			SELECT st.id, st.question, ({correct}), ({selected})
+			FROM results AS st
+			INNER JOIN results AS nerd
+			ON nerd.id = ? AND nerd.question = st.question
+		""", (self.nerd.id,))
+		cur.execute("CREATE INDEX IF NOT EXISTS correctness_id_question ON correctness(id, question)")
+
 # Checks are to be done in here
 #	def check_tables(self, conn: sqlite3.Connection):
 #		cur = conn.cursor()
@@ -108,28 +171,63 @@ class SqlAnalyzer(AnswerStatistics):
 		elif self.sql_path.is_dir():
 			all_files = self.sql_path.glob('**/*.sql') # gets everything with name = *.sql
 			all_files = [path for path in all_files if path.is_file()] # filters for files
-			return all_files
+			return sorted(all_files) # sheets appear in the same order on every run
 		else:
 			raise ValueError("Unknown Path type")
 
 
 
 	def execute_sql(self, conn: sqlite3.Connection)->StatisticsBook:
-		cur = conn.cursor()
+		files = self.get_sql_files()
+		jobs = min(self.worker_count(), len(files))
 		book = StatisticsBook()
 
-		for file in self.get_sql_files():
-			query = file.read_text()
-			sheet = StatisticsSheet(file.stem)
-			cur.execute(query)
-			sheet.rows.append(StatisticsRow([col_data[0] for col_data in cur.description]))
-			for row in cur.fetchall():
-				str_row = [str(value) for value in row]
-				sheet.rows.append(StatisticsRow(str_row))
-			book.sheets.append(sheet)
+		if self.stream:
+			# Queries run once a printer reads the rows
+			for file in files:
+				book.sheets.append(StatisticsSheet(file.stem, rows=self.stream_file(file)))
+		elif jobs > 1:
+			with ThreadPoolExecutor(max_workers=jobs) as executor:
+				# map() yields in submission order, so sheets keep the order of the files
+				book.sheets.extend(executor.map(self.execute_file, files))
+		else:
+			for file in files:
+				book.sheets.append(self.execute_file(file, conn))
 
 		return book
 
+	def execute_file(self, file: Path, conn: Optional[sqlite3.Connection]=None) -> StatisticsSheet:
+		""" Runs the query of `file`. Without a connection, it runs on a new read-only connection """
+		reader = conn if conn is not None else self.create_reader()
+		try:
+			with profiling.span(f"sql.query.{file.stem}"):
+				cur = reader.cursor()
+				query = file.read_text()
+				cur.execute(query)
+				# Values keep the types sqlite returns them in.
+				# sqlite releases the GIL while stepping through the query
+				return ColumnarSheet.from_rows(file.stem, [col_data[0] for col_data in cur.description], cur)
+		finally:
+			if conn is None:
+				reader.close()
+
+	def stream_file(self, file: Path) -> Iterator[StatisticsRow]:
+		""" Runs the query of `file` on its own read-only connection and yields the rows as they are produced """
+		name = f"sql.query.{file.stem}"
+		with closing(self.create_reader()) as reader:
+			with profiling.span(name):
+				cur = reader.cursor()
+				cur.execute(file.read_text())
+			yield StatisticsRow([col_data[0] for col_data in cur.description])
+			while True:
+				# Only the time sqlite needs, not the time the printer takes between the rows
+				with profiling.span(name, count=0):
+					rows = cur.fetchmany(self.FETCH_SIZE)
+				if not rows:
+					break
+				for row in rows:
+					yield StatisticsRow([str(value) for value in row])
+
 
 
 # =========================================================
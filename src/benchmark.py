@@ -0,0 +1,241 @@
+"""
+Benchmark of every stage of the program over the bundled fixtures (`sheet/*.pdf`, `pic/*.png`).
+
+Run from the repository root:
+	python src/benchmark.py --save baseline.json
+	python src/benchmark.py --baseline baseline.json
+
+Times are the best of `--repeat` rounds. With `--baseline`, stages that got slower than the
+baseline by more than `--threshold` are reported and the exit code is 1
+"""
+from analysis.sql import SqlAnalyzer
+from containers import Student, Answer, StatisticsBook
+from parsers.png import PngParser
+from printers.csv import CsvPrinter
+from printers.excel import ExcelPrinter
+from pathlib import Path
+from typing import Any, Optional
+from argparse import ArgumentParser
+from contextlib import contextmanager, closing
+from collections import defaultdict
+from tempfile import TemporaryDirectory
+import json
+import platform
+import shutil
+import sys
+import time
+
+import cv2
+import numpy
+
+try:
+	import resource
+except ImportError:
+	resource = None # Not available on Windows
+
+ROOT = Path(__file__).resolve().parent.parent
+
+class Timings:
+	""" Accumulated seconds and amount of items per stage """
+
+	def __init__(self) -> None:
+		self.seconds: dict[str, float] = defaultdict(float)
+		self.items: dict[str, int] = defaultdict(int)
+
+	@contextmanager
+	def stage(self, name: str, items: int=1):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.seconds[name] += time.perf_counter() - start
+			self.items[name] += items
+
+TIMINGS = Timings()
+
+class StagedParser(PngParser):
+	""" `PngParser` that records the time of its stages. Nested stages are part of their parent's time """
+
+	def find_answer_box(self):
+		with TIMINGS.stage("png.find_answer_box"):
+			return super().find_answer_box()
+
+	def get_checkboxes(self):
+		with TIMINGS.stage("png.get_checkboxes"):
+			return super().get_checkboxes()
+
+	def classify_boxes(self, grid):
+		with TIMINGS.stage("png.classify_boxes"):
+			return super().classify_boxes(grid)
+
+	def group_checkboxes(self, grid):
+		with TIMINGS.stage("png.group_checkboxes"):
+			return super().group_checkboxes(grid)
+
+def peak_rss() -> Optional[int]:
+	""" Peak resident memory of this process in bytes, if the platform reports it """
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports KiB, macOS bytes
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+def rasterize(pdf_files: list[Path]) -> list[Any]:
+	""" Rasterizes all pages like `PdfParser` """
+	from parsers.pdf import PdfParser
+	images = []
+	for pdf_file in pdf_files:
+		parser = PdfParser([pdf_file, None, None])
+		with TIMINGS.stage("pdf.rasterize", items=0):
+			pages = parser.pdf_to_images(pdf_file)
+		TIMINGS.items["pdf.rasterize"] += len(pages)
+		images.extend(pages)
+	return images
+
+def parse(images: list[Any]) -> list[Student]:
+	students = []
+	for index, image in enumerate(images):
+		with TIMINGS.stage("png.load"):
+			# Grayscale, like `PngParser` and `PngParser.from_image()` load pages
+			if isinstance(image, Path):
+				image = cv2.imread(str(image), cv2.IMREAD_GRAYSCALE)
+			elif image.mode == 'L':
+				image = numpy.asarray(image)
+			else:
+				image = cv2.cvtColor(numpy.asarray(image.convert('RGB')), cv2.COLOR_RGB2GRAY)
+
+		try:
+			# Scaling, thresholding and cropping, without the nested search of the answer box
+			find_answer_box = TIMINGS.seconds["png.find_answer_box"]
+			with TIMINGS.stage("png.threshold"):
+				parser = StagedParser([image, None, None])
+			TIMINGS.seconds["png.threshold"] -= TIMINGS.seconds["png.find_answer_box"] - find_answer_box
+
+			grid = parser.extractGrid()
+		except AssertionError:
+			# Fixtures without (complete) answer box
+			TIMINGS.items["png.failed"] += 1
+			continue
+
+		students.append(Student(index, [Answer(options) for options in grid.options()]))
+	return students
+
+def analyze(students: list[Student], nerd: Student, sql_path: Path) -> StatisticsBook:
+	analyzer = SqlAnalyzer(students, nerd=nerd, sql_path=sql_path)
+	with closing(analyzer.create_connection()) as conn:
+		with TIMINGS.stage("sql.load", items=len(students)):
+			analyzer.create_table(conn)
+			analyzer.insert_data(conn)
+			analyzer.create_correctness(conn)
+			conn.commit()
+
+		book = StatisticsBook()
+		for file in analyzer.get_sql_files():
+			with TIMINGS.stage(f"sql.query.{file.stem}"):
+				book.sheets.append(analyzer.execute_file(file, conn))
+	return book
+
+def output(book: StatisticsBook):
+	with TemporaryDirectory() as directory:
+		with TIMINGS.stage("print.csv"):
+			CsvPrinter(book, Path(directory) / "results.csv").printStatistics()
+		with TIMINGS.stage("print.xlsx"):
+			ExcelPrinter(book, Path(directory) / "results.xlsx").printStatistics()
+
+def run_round(pdf_files: list[Path], png_files: list[Path], class_size: int, sql_path: Path) -> dict[str, Any]:
+	global TIMINGS
+	TIMINGS = Timings()
+	start = time.perf_counter()
+
+	images = [*rasterize(pdf_files), *png_files]
+	students = parse(images)
+	if len(students) == 0:
+		raise ValueError("No fixture could be parsed")
+
+	# Reports over a class of realistic size, built from the parsed sheets
+	nerd = students[0]
+	copies = (class_size + len(students) - 1) // len(students)
+	class_students = [Student(copy * len(students) + index + 1, student.answers)
+		for copy in range(copies) for index, student in enumerate(students)][:class_size]
+	book = analyze(class_students, nerd, sql_path)
+	output(book)
+
+	parse_seconds = sum(seconds for stage, seconds in TIMINGS.seconds.items() if stage in ("png.load", "png.threshold", "png.find_answer_box", "png.get_checkboxes", "png.group_checkboxes"))
+	pages = len(images) - TIMINGS.items["png.failed"]
+	return {
+		"stages": dict(TIMINGS.seconds),
+		"items": dict(TIMINGS.items),
+		"pages": pages,
+		"pages_per_second": pages / parse_seconds if parse_seconds > 0 else None,
+		"total": time.perf_counter() - start,
+	}
+
+def best_of(rounds: list[dict[str, Any]]) -> dict[str, Any]:
+	""" Fastest time of every stage over all rounds """
+	best = min(rounds, key=lambda result: result["total"])
+	stages = {stage: min(result["stages"].get(stage, float('inf')) for result in rounds) for stage in best["stages"]}
+	return best | {"stages": stages}
+
+def compare(result: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[str]:
+	""" Stages slower than the baseline by more than `threshold` (relative) """
+	regressions = []
+	for stage, seconds in result["stages"].items():
+		before = baseline["stages"].get(stage)
+		if before is not None and before > 0 and seconds > before * (1 + threshold):
+			regressions.append(f"{stage}: {before * 1000:.1f}ms -> {seconds * 1000:.1f}ms ({seconds / before - 1:+.0%})")
+	return regressions
+
+def report(result: dict[str, Any]):
+	print(f"{'stage':<40}{'total ms':>12}{'items':>8}{'ms/item':>10}")
+	for stage, seconds in sorted(result["stages"].items()):
+		items = result["items"].get(stage, 0)
+		per_item = f"{seconds * 1000 / items:.2f}" if items > 0 else "-"
+		print(f"{stage:<40}{seconds * 1000:>12.1f}{items:>8}{per_item:>10}")
+	if result["items"].get("png.failed"):
+		print(f"{result['items']['png.failed']} fixtures could not be parsed")
+	if result["pages_per_second"] is not None:
+		print(f"{result['pages']} pages, {result['pages_per_second']:.2f} pages/s (parsing only)")
+	if result["peak_rss"] is not None:
+		print(f"Peak RSS: {result['peak_rss'] / (1024 * 1024):.1f} MiB")
+
+def main():
+	argparser = ArgumentParser(prog="benchmark", description="Time every stage over the bundled fixtures")
+	argparser.add_argument('--pdf', nargs='*', type=Path, default=sorted((ROOT / 'sheet').glob('*.pdf')), help="PDF files to rasterize and parse (Default: sheet/*.pdf)")
+	argparser.add_argument('--png', nargs='*', type=Path, default=sorted((ROOT / 'pic').glob('*.png')), help="Images to parse (Default: pic/*.png)")
+	argparser.add_argument('-q', '--sql', type=Path, default=ROOT / 'sql_queries', help="Queries to run (Default: sql_queries)")
+	argparser.add_argument('--students', type=int, default=500, help="Size of the class the queries run on (Default: 500)")
+	argparser.add_argument('-r', '--repeat', type=int, default=3, help="Rounds, every stage counts with its best time (Default: 3)")
+	argparser.add_argument('--save', type=Path, default=None, help="Write the results as JSON baseline")
+	argparser.add_argument('--baseline', type=Path, default=None, help="Compare with a JSON baseline")
+	argparser.add_argument('--threshold', type=float, default=0.10, help="Relative slowdown reported as regression (Default: 0.10)")
+	args = argparser.parse_args()
+
+	# Results don't depend on the machine's thread count
+	cv2.setNumThreads(1)
+
+	if len(args.pdf) > 0 and shutil.which("pdftoppm") is None:
+		print("Skipping rasterization, poppler is not installed")
+		args.pdf = []
+
+	rounds = [run_round(args.pdf, args.png, args.students, args.sql) for _ in range(args.repeat)]
+	result = best_of(rounds) | {
+		"peak_rss": peak_rss(),
+		"python": platform.python_version(),
+		"opencv": cv2.__version__,
+		"machine": platform.machine(),
+	}
+	report(result)
+
+	if args.save is not None:
+		args.save.write_text(json.dumps(result, indent=2))
+
+	if args.baseline is not None:
+		regressions = compare(result, json.loads(args.baseline.read_text()), args.threshold)
+		for regression in regressions:
+			print(f"REGRESSION {regression}")
+		if len(regressions) > 0:
+			sys.exit(1)
+		print(f"No stage slower than the baseline by more than {args.threshold:.0%}")
+
+if __name__ == "__main__":
+	main()
@@ -1,4 +1,8 @@
 from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, Optional, Sequence
+from array import array
+from pathlib import Path
+import os
 
 @dataclass
 class Answer:
@@ -25,6 +29,50 @@ class Student:
 	def has_missing(self) -> bool:
 		return any(a.has_missing() for a in self.answers)
 
+@dataclass
+class ParserOptions:
+	jobs: int = 1
+	"""
+	Amount of worker processes used to analyze pages.
+	`0` uses one process per CPU core
+	"""
+	template: bool = False
+	"""
+	Detect the checkbox grid once and reuse it for all following sheets
+	"""
+	layout: Any = None
+	"""
+	Checkbox grid used as template (`parsers.png.SheetLayout`).
+	Set by the first parser that finds a clean sheet if `template` is enabled
+	"""
+	store: Optional[Path] = None
+	"""
+	SQLite file that keeps the results of parsed pages between runs.
+	Only new or changed pages are parsed again
+	"""
+	cache: Optional[Path] = None
+	"""
+	Directory that keeps the results of pages by content, shared between all files and runs
+	"""
+	cache_size: int = 256 * 1024 * 1024
+	"""
+	Size in bytes up to which `cache` may grow before least recently used pages are removed
+	"""
+	raster_files: bool = False
+	"""
+	Rasterize PDF pages into uncompressed temporary files that are mapped into memory,
+	instead of decoding them from poppler's output
+	"""
+
+	def worker_count(self) -> int:
+		return worker_count(self.jobs)
+
+def worker_count(jobs: int) -> int:
+	""" Amount of workers for a `--jobs` value, `0` or less is one per CPU core """
+	if jobs <= 0:
+		jobs = os.cpu_count() or 1
+	return max(1, jobs)
+
 @dataclass
 class StatisticsRow:
 	values: list[str] = field(default_factory=lambda:[])
@@ -32,9 +80,127 @@ class StatisticsRow:
 @dataclass
 class StatisticsSheet:
 	name: str
-	rows: list[StatisticsRow] = field(default_factory=lambda:[])
+	rows: Iterable[StatisticsRow] = field(default_factory=lambda:[])
+	"""
+	Usually a list. Analyzers may instead provide an iterator that produces the rows on demand,
+	which can only be read once
+	"""
+
+	def values(self) -> Iterator[list[Any]]:
+		""" Values of every row, including the header. Sheets that know the types of their values return them as such """
+		for row in self.rows:
+			yield row.values
+
+@dataclass
+class StatisticsColumn:
+	name: str
+	values: Sequence[Any] = field(default_factory=lambda:[])
+	"""
+	`array('q')` for integers, `array('d')` for floats.
+	Otherwise a list of the values (strings or mixed types)
+	"""
+	nulls: bytearray = field(default_factory=bytearray)
+	"""
+	`1` for every row without value (NULL). `values` contains a placeholder there
+	"""
+
+	@classmethod
+	def from_values(cls, name: str, values: list[Any]) -> "StatisticsColumn":
+		nulls = bytearray(value is None for value in values)
+		kinds = {type(value) for value in values if value is not None}
+		typed: Sequence[Any] = values
+		if kinds == {int}:
+			try:
+				typed = array('q', (0 if value is None else value for value in values))
+			except OverflowError:
+				pass # Larger than 64 bit, stays a list
+		elif kinds == {float}:
+			typed = array('d', (0.0 if value is None else value for value in values))
+		return cls(name=name, values=typed, nulls=nulls)
+
+	def __len__(self) -> int:
+		return len(self.values)
+
+	def get(self, index: int) -> Any:
+		return None if self.nulls[index] else self.values[index]
+
+class ColumnarSheet(StatisticsSheet):
+	"""
+	Sheet stored as typed columns instead of string rows.
+	`rows` is a view with the usual string values
+	"""
+	columns: list[StatisticsColumn]
+
+	def __init__(self, name: str, columns: list[StatisticsColumn]) -> None:
+		self.name = name
+		self.columns = columns
+
+	@classmethod
+	def from_rows(cls, name: str, header: list[str], rows: Iterable[Sequence[Any]]) -> "ColumnarSheet":
+		""" Builds the columns from rows of values, e.g. a database cursor """
+		data: list[list[Any]] = [[] for _ in header]
+		for row in rows:
+			for column, value in zip(data, row):
+				column.append(value)
+		return cls(name, [StatisticsColumn.from_values(column_name, values) for column_name, values in zip(header, data)])
+
+	@property
+	def row_count(self) -> int:
+		return len(self.columns[0]) if len(self.columns) > 0 else 0
+
+	@property
+	def rows(self) -> list[StatisticsRow]:
+		values = self.values()
+		header = StatisticsRow(next(values))
+		return [header, *(StatisticsRow([str(value) for value in row]) for row in values)]
+
+	def values(self) -> Iterator[list[Any]]:
+		yield [column.name for column in self.columns]
+		for index in range(self.row_count):
+			yield [column.get(index) for column in self.columns]
 
 @dataclass
 class StatisticsBook:
 	sheets: list[StatisticsSheet] = field(default_factory=lambda:[])
 
+
+class SheetCombiner:
+	"""
+	Collects the students of several files into one list, one file after the other.
+
+	Ids of later files are moved behind those of earlier files if they overlap, and no sheet keeps the id of
+	the solution. Ids within a file are expected to increase, like page numbers. `sources` maps every id to its file
+	"""
+
+	students: list[Student]
+	sources: StatisticsSheet
+	solution_id: Optional[int]
+
+	def __init__(self, solution_id: Optional[int]=None) -> None:
+		self.students = []
+		self.sources = StatisticsSheet("sources", rows=[StatisticsRow(["id", "source"])])
+		self.solution_id = solution_id
+		# Behind all ids so far
+		self.next_id: Optional[int] = None
+		# Shift of the ids of the current file, known with its first sheet
+		self.offset: Optional[int] = None
+
+	def add(self, file: Path, students: Sequence[Student]):
+		""" Adds sheets of `file`. Can be called repeatedly until `end_file()` """
+		if len(students) == 0:
+			return
+		if self.offset is None:
+			self.offset = max(0, self.next_id - min(student.id for student in students)) if self.next_id is not None else 0
+
+		for student in students:
+			if student.id + self.offset == self.solution_id:
+				# This sheet and the rest of the file move behind the solution and all ids so far
+				target = max(self.solution_id + 1, self.next_id if self.next_id is not None else self.solution_id + 1)
+				self.offset = target - student.id
+			student.id += self.offset
+			self.next_id = student.id + 1 if self.next_id is None else max(self.next_id, student.id + 1)
+			self.sources.rows.append(StatisticsRow([str(student.id), str(file)]))
+		self.students.extend(students)
+
+	def end_file(self):
+		self.offset = None
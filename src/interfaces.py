@@ -1,28 +1,88 @@
 import abc
-from containers import Student, StatisticsBook
+from containers import Student, StatisticsBook, ParserOptions
 from pathlib import Path
-from typing import Optional, Any, Type
+from typing import Optional, Any, Type, Iterator, Union
+import importlib
+import threading
+
+class LazyPlugin:
+	"""
+	Registration of a plugin module by file extensions.
+	The module is only imported once a file with one of the extensions is requested. It registers its classes itself
+	"""
+	# Imports of plugins requested by several threads at once happen only once
+	LOCK = threading.RLock()
+
+	extensions: set[str]
+	module: str
+
+	def __init__(self, extensions: set[str], module: str) -> None:
+		self.extensions = {e.casefold() for e in extensions}
+		self.module = module
+
+	def matches(self, path: Any) -> bool:
+		return Path(path).suffix.casefold() in self.extensions
+
+	def load(self, registry: list):
+		""" Replaces this registration in `registry` by the classes the module registers """
+		if self in registry:
+			registry.remove(self)
+			importlib.import_module(self.module)
 
 class AnswerParser:
-	__parsers__: list[Type["AnswerParser"]] = []
+	__parsers__: list[Union[Type["AnswerParser"], LazyPlugin]] = []
 
 	EXTENSIONS: set[str] = set()
 
 	@staticmethod
-	def register(parser: Type["AnswerParser"]):
-		AnswerParser.__parsers__.append(parser)
+	def register(parser: Union[Type["AnswerParser"], set[str]], module: Optional[str]=None):
+		""" Registers a parser class, or a set of extensions and the module that contains their parser """
+		if module is not None:
+			AnswerParser.__parsers__.append(LazyPlugin(parser, module))
+		else:
+			AnswerParser.__parsers__.append(parser)
 
 	@staticmethod
 	def getParser(args: list[Any]) -> Optional["AnswerParser"]:
-		for parserClass in AnswerParser.__parsers__:
-			if parserClass.canParse(args):
-				return parserClass(args)
+		if parserClass := AnswerParser.findParser(args):
+			return parserClass(args)
 		return None
+
+	@staticmethod
+	def findParser(args: list[Any]) -> Optional[Type["AnswerParser"]]:
+		""" Returns the first registered parser class that can parse `args` without creating it """
+		with LazyPlugin.LOCK:
+			for parserClass in list(AnswerParser.__parsers__):
+				if isinstance(parserClass, LazyPlugin):
+					if parserClass.matches(args[0]):
+						parserClass.load(AnswerParser.__parsers__)
+						return AnswerParser.findParser(args)
+				elif parserClass.canParse(args):
+					return parserClass
+		return None
+
+	@staticmethod
+	def isSupported(args: list[Any]) -> bool:
+		""" Like `findParser()`, but without importing lazily registered parsers """
+		return any(
+			parserClass.matches(args[0]) if isinstance(parserClass, LazyPlugin) else parserClass.canParse(args)
+			for parserClass in list(AnswerParser.__parsers__))
 	
+	@staticmethod
+	def getOptions(args: list[Any]) -> ParserOptions:
+		""" Returns the `ParserOptions` passed as third argument or the defaults """
+		if len(args) > 2 and args[2] is not None:
+			return args[2]
+		return ParserOptions()
+
 	@abc.abstractmethod
 	def extractAnswers(self) -> list[Student]:
 		pass
 
+	def iterAnswers(self) -> Iterator[Student]:
+		""" Yields students one by one. Parsers that can stream their input should override this """
+		yield from self.extractAnswers()
+
 	@classmethod
 	def canParse(cls, args: list[Any]) -> bool:
 		return Path(args[0]).suffix.casefold() in {e.casefold() for e in cls.EXTENSIONS}
@@ -52,7 +112,7 @@ class StatisticsPrinter:
 		pass
 
 class FilePrinter(StatisticsPrinter):
-	__printers__: list[Type["FilePrinter"]] = []
+	__printers__: list[Union[Type["FilePrinter"], LazyPlugin]] = []
 	
 	EXTENSIONS: set[str] = set()
 
@@ -63,14 +123,23 @@ class FilePrinter(StatisticsPrinter):
 		self.filePath = Path(path)
 
 	@staticmethod
-	def register(parser: Type["FilePrinter"]):
-		FilePrinter.__printers__.append(parser)
+	def register(parser: Union[Type["FilePrinter"], set[str]], module: Optional[str]=None):
+		""" Registers a printer class, or a set of extensions and the module that contains their printer """
+		if module is not None:
+			FilePrinter.__printers__.append(LazyPlugin(parser, module))
+		else:
+			FilePrinter.__printers__.append(parser)
 
 	@staticmethod
 	def getPrinter(path: Any, book: StatisticsBook) -> Optional["FilePrinter"]:
-		for printerClass in FilePrinter.__printers__:
-			if printerClass.canPrint(path=Path(path), book=book):
-				return printerClass(book, path=Path(path))
+		with LazyPlugin.LOCK:
+			for printerClass in list(FilePrinter.__printers__):
+				if isinstance(printerClass, LazyPlugin):
+					if printerClass.matches(path):
+						printerClass.load(FilePrinter.__printers__)
+						return FilePrinter.getPrinter(path, book=book)
+				elif printerClass.canPrint(path=Path(path), book=book):
+					return printerClass(book, path=Path(path))
 		return None
 	
 	@classmethod
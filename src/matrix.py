@@ -0,0 +1,153 @@
+from containers import Student
+from typing import Iterator, Sequence
+
+import numpy
+
+class AnswerMatrix:
+	"""
+	Answers of many students in a single `uint8` array shaped (students, questions, boxes).
+
+	Each entry is the ASCII code of the char in `Answer.options` ('X', 'x', 'O', 'o', '#').
+	`0` pads questions and boxes a student does not have.
+	"""
+	__slots__ = ('codes', 'ids', 'count')
+
+	codes: numpy.ndarray
+	ids: numpy.ndarray
+	count: int
+
+	def __init__(self, students: int=0, questions: int=0, boxes: int=0) -> None:
+		self.codes = numpy.zeros((students, questions, boxes), dtype=numpy.uint8)
+		self.ids = numpy.zeros(students, dtype=numpy.int64)
+		self.count = 0
+
+	@classmethod
+	def from_students(cls, students: Sequence[Student]) -> "AnswerMatrix":
+		questions = max((len(student.answers) for student in students), default=0)
+		boxes = max((len(answer.options) for student in students for answer in student.answers), default=0)
+		matrix = cls(len(students), questions, boxes)
+		for student in students:
+			matrix.append(student.id, encode([answer.options for answer in student.answers]))
+		return matrix
+
+	def reserve(self, students: int, questions: int, boxes: int):
+		""" Grows the matrix to hold at least the given dimensions """
+		(capacity, current_questions, current_boxes) = self.codes.shape
+		if students <= capacity and questions <= current_questions and boxes <= current_boxes:
+			return
+		# Grow geometrically in the student dimension, appending stays amortized O(1)
+		shape = (max(students, 2 * capacity), max(questions, current_questions), max(boxes, current_boxes))
+		codes = numpy.zeros(shape, dtype=numpy.uint8)
+		codes[:capacity, :current_questions, :current_boxes] = self.codes
+		ids = numpy.zeros(shape[0], dtype=numpy.int64)
+		ids[:capacity] = self.ids
+		self.codes, self.ids = codes, ids
+
+	def append(self, id: int, codes: numpy.ndarray) -> "StudentView":
+		""" Adds a student from its (questions, boxes) code array, see `encode()` """
+		(questions, boxes) = codes.shape
+		self.reserve(self.count + 1, questions, boxes)
+		self.codes[self.count, :questions, :boxes] = codes
+		self.ids[self.count] = id
+		self.count += 1
+		return StudentView(self, self.count - 1)
+
+	def __len__(self) -> int:
+		return self.count
+
+	def __getitem__(self, index: int) -> "StudentView":
+		if not -self.count <= index < self.count:
+			raise IndexError("student index out of range")
+		return StudentView(self, index % self.count)
+
+	def __iter__(self) -> Iterator["StudentView"]:
+		return (StudentView(self, index) for index in range(self.count))
+
+	def students(self) -> list["StudentView"]:
+		return list(self)
+
+	def question_counts(self) -> numpy.ndarray:
+		""" Amount of questions of every student """
+		present = (self.codes[:self.count] != 0).any(axis=2)
+		if present.shape[1] == 0:
+			return numpy.zeros(self.count, dtype=numpy.int64)
+		# Index of the last present question + 1
+		return numpy.where(present.any(axis=1), present.shape[1] - numpy.argmax(present[:, ::-1], axis=1), 0)
+
+	def question_count(self, index: int) -> int:
+		present = (self.codes[index] != 0).any(axis=1)
+		return int(len(present) - numpy.argmax(present[::-1])) if present.any() else 0
+
+	def selected(self) -> numpy.ndarray:
+		""" Boolean array of boxes that are (probably) selected """
+		codes = self.codes[:self.count]
+		return (codes == ord('X')) | (codes == ord('x'))
+
+	def missing(self) -> numpy.ndarray:
+		""" Boolean array of boxes that could not be detected reliably """
+		return self.codes[:self.count] == ord('#')
+
+	def has_missing(self) -> numpy.ndarray:
+		""" Per student whether any box could not be detected reliably """
+		return self.missing().any(axis=(1, 2))
+
+def encode(options: Sequence[str]) -> numpy.ndarray:
+	""" Converts `Answer.options` strings into a (questions, boxes) code array """
+	boxes = max((len(option) for option in options), default=0)
+	codes = numpy.zeros((len(options), boxes), dtype=numpy.uint8)
+	for question, option in enumerate(options):
+		codes[question, :len(option)] = numpy.frombuffer(option.encode('ascii'), dtype=numpy.uint8)
+	return codes
+
+class AnswerView:
+	""" `Answer` backed by a row of an `AnswerMatrix` """
+	__slots__ = ('matrix', 'student', 'question')
+
+	def __init__(self, matrix: AnswerMatrix, student: int, question: int) -> None:
+		self.matrix = matrix
+		self.student = student
+		self.question = question
+
+	@property
+	def options(self) -> str:
+		return self.matrix.codes[self.student, self.question].tobytes().rstrip(b'\0').decode('ascii')
+
+	@options.setter
+	def options(self, value: str):
+		encoded = numpy.frombuffer(value.encode('ascii'), dtype=numpy.uint8)
+		self.matrix.reserve(self.matrix.count, self.question + 1, len(encoded))
+		row = self.matrix.codes[self.student, self.question]
+		row[:] = 0
+		row[:len(encoded)] = encoded
+
+	def has_missing(self) -> bool:
+		return bool((self.matrix.codes[self.student, self.question] == ord('#')).any())
+
+	def __repr__(self) -> str:
+		return f"Answer(options={self.options!r})"
+
+class StudentView:
+	""" `Student` backed by an `AnswerMatrix` """
+	__slots__ = ('matrix', 'index')
+
+	def __init__(self, matrix: AnswerMatrix, index: int) -> None:
+		self.matrix = matrix
+		self.index = index
+
+	@property
+	def id(self) -> int:
+		return int(self.matrix.ids[self.index])
+
+	@id.setter
+	def id(self, value: int):
+		self.matrix.ids[self.index] = value
+
+	@property
+	def answers(self) -> list[AnswerView]:
+		return [AnswerView(self.matrix, self.index, question) for question in range(self.matrix.question_count(self.index))]
+
+	def has_missing(self) -> bool:
+		return bool((self.matrix.codes[self.index] == ord('#')).any())
+
+	def __repr__(self) -> str:
+		return f"Student(id={self.id}, answers={self.answers!r})"
@@ -1,11 +1,15 @@
 
 from interfaces import AnswerParser
-import parsers.csv
-import parsers.pdf
-import parsers.png
+
+# Parser modules are only imported once a file of their type is parsed
+AnswerParser.register({'.csv'}, 'parsers.csv')
+AnswerParser.register({'.pdf'}, 'parsers.pdf')
+AnswerParser.register({'.png'}, 'parsers.png')
 
 from typing import Optional
 from containers import Student
+from pathlib import Path
+import glob
 
 def get_parser(args: list[str]) -> Optional[AnswerParser]:
     return AnswerParser.getParser(args=args)
@@ -16,3 +20,48 @@ def get_parser_result(args: list[str]) -> Optional[list[Student]]:
 	else:
 		return None
 
+
+# Chars that make a pattern a glob pattern, see `glob.glob()`
+GLOB_CHARS = "*?["
+
+def find_sheets(patterns: list[str]) -> list[Path]:
+	"""
+	Expands files, directories and glob patterns into the files to parse.
+	Directories contain every file a registered parser can read. Files appear once, in the given order
+	"""
+	sheets: list[Path] = []
+	for pattern in patterns:
+		path = Path(pattern)
+		if path.is_dir():
+			found = sorted(file for file in path.iterdir() if file.is_file() and AnswerParser.isSupported([file]))
+		elif any(char in pattern for char in GLOB_CHARS):
+			found = sorted(Path(file) for file in glob.glob(pattern, recursive=True) if Path(file).is_file())
+		else:
+			found = [path]
+		sheets.extend(file for file in found if file not in sheets)
+	return sheets
+
+def sheet_names(files: list[Path]) -> list[str]:
+	"""
+	Distinct names of `files`, e.g. for one output per file. The stem of a file, where that is ambiguous
+	followed by its suffix and preceded by as many parent directories as needed
+	"""
+	files = [Path(file).absolute() for file in files]
+	levels = [0] * len(files)
+
+	def name(file: Path, level: int) -> str:
+		if level == 0:
+			return file.stem
+		directories = list(file.parent.parts[1:])[-(level - 1):] if level > 1 else []
+		return "_".join([*directories, file.stem, file.suffix.lstrip('.')])
+
+	while True:
+		names = [name(file, level) for file, level in zip(files, levels)]
+		duplicates = {index for index, value in enumerate(names) if names.count(value) > 1}
+		if len(duplicates) == 0:
+			return names
+		if any(levels[index] > len(files[index].parts) for index in duplicates):
+			# The same file given twice
+			return [f"{name(files[index], 1)}_{index}" if index in duplicates else value for index, value in enumerate(names)]
+		for index in duplicates:
+			levels[index] += 1
@@ -1,51 +1,338 @@
 from interfaces import AnswerParser
-from containers import Student
+from containers import Student, ParserOptions
 from pathlib import Path
-import tempfile
-from parsers.png import PngParser
+from typing import Any, AsyncIterator, Iterator, Optional, TypeAlias, Union
+from concurrent.futures import ProcessPoolExecutor, Executor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from tempfile import TemporaryDirectory
+import asyncio
+import functools
+import itertools
+import re
+import signal
+import threading
+from parsers.png import PngParser, CheckGrid
+from matrix import AnswerMatrix
+from store import ResultStore, PageCache, file_hash, image_hash
+import profiling
 
+import cv2
+import numpy
+from PIL.Image import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
 
-from pdf2image import convert_from_path
-
-# (sudo apt install python3-pip) falls pip nicht installiert 
+# (sudo apt install python3-pip) falls pip nicht installiert
 # pip install PyPDF2 pdf2image
 # sudo apt-get install poppler-utils
 
+def init_worker():
+	# Ctrl+C is handled by the main process, which shuts the pool down. Running pages are finished
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	# Every worker already occupies one core, OpenCV must not spawn additional threads
+	cv2.setNumThreads(1)
+	# Spans of the parent up to the fork would otherwise be sent back and merged again by `profile_call()`
+	profiling.reset()
+	# Structuring elements are ready before the first page arrives
+	PngParser.line_kernels(PngParser.LARGE_LINE_SIZE)
+	PngParser.line_kernels(PngParser.BOX_LINE_SIZE)
+
+# Process pools by size, shared by all parsers of this process
+EXECUTORS: dict[int, ProcessPoolExecutor] = {}
+EXECUTORS_LOCK = threading.Lock()
+
+def shared_executor(jobs: int) -> ProcessPoolExecutor:
+	"""
+	Process pool shared by all parsers, so pages of many files are scheduled on the same workers.
+	The workers stay alive until the program exits, or until the pool broke (see `discard_executor()`)
+	"""
+	with EXECUTORS_LOCK:
+		if jobs not in EXECUTORS:
+			EXECUTORS[jobs] = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker)
+		return EXECUTORS[jobs]
+
+def discard_executor(executor: Executor):
+	""" Drops a pool whose worker died (e.g. out of memory), so later parsers get a new one """
+	with EXECUTORS_LOCK:
+		for jobs, shared in list(EXECUTORS.items()):
+			if shared is executor:
+				del EXECUTORS[jobs]
+	executor.shutdown(wait=False, cancel_futures=True)
+
+def warm_up(jobs: int):
+	""" Starts the workers of the shared pool for `jobs` ahead of the first file """
+	executor = shared_executor(jobs)
+	# Workers are started on demand, one task per worker starts all of them
+	for future in [executor.submit(init_worker) for _ in range(jobs)]:
+		future.result()
+
+# A rasterized page, either decoded or as PGM file (see `ParserOptions.raster_files`)
+Page: TypeAlias = Union[Image, Path]
+
+# Whitespace and comments, followed by a token of a PNM header
+PNM_TOKEN = re.compile(rb'(?:\s|#[^\n]*\n)*([^\s#]+)')
+
+def read_pgm(path: Path) -> numpy.ndarray:
+	""" Maps the pixels of a binary PGM file (`P5`) into memory. Nothing is decoded or copied up front """
+	with open(path, 'rb') as file:
+		header = file.read(256)
+	tokens: list[bytes] = []
+	position = 0
+	while len(tokens) < 4:
+		match = PNM_TOKEN.match(header, position)
+		if match is None:
+			raise ValueError(f"Image header of '{path}' is incomplete")
+		tokens.append(match.group(1))
+		position = match.end()
+
+	(magic, width, height, max_value) = tokens
+	if magic != b'P5' or int(max_value) > 255:
+		raise ValueError(f"'{path}' is not an 8 bit PGM file")
+	# A single whitespace separates the header from the pixels
+	return numpy.memmap(path, dtype=numpy.uint8, mode='r', offset=position + 1, shape=(int(height), int(width)))
+
+def open_page(page: Page) -> Union[Image, numpy.ndarray]:
+	return read_pgm(page) if isinstance(page, Path) else page
+
+def parse_page(image: Page, options: Optional[ParserOptions]=None) -> numpy.ndarray:
+	parser = PngParser.from_image(open_page(image), options)
+	# Codes are compact to send back from worker processes
+	return parser.extractCodes()
+
+def profile_call(parse, image: Page, options: Optional[ParserOptions]=None) -> tuple[Any, dict[str, Any]]:
+	""" Runs `parse` in a worker process. Returns its result and what it recorded, see `profiling.collect()` """
+	profiling.enable()
+	result = parse(image, options)
+	return result, profiling.collect()
+
+def parse_page_grid(image: Page, options: Optional[ParserOptions]=None) -> CheckGrid:
+	parser = PngParser.from_image(open_page(image), options)
+	# The whole grid, including the geometry, for the page cache
+	return parser.extractGrid()
+
+async def read_pnm(stream: asyncio.StreamReader) -> Optional[numpy.ndarray]:
+	"""
+	Reads the next binary PGM/PPM image (`P5`/`P6`) from a stream of concatenated images, like poppler writes to stdout.
+	Returns a grayscale image, `None` at the end of the stream. The header has to end with a newline, as poppler writes it
+	"""
+	tokens: list[bytes] = []
+	while len(tokens) < 4:
+		line = await stream.readline()
+		if line == b'':
+			if len(tokens) == 0:
+				return None
+			raise ValueError("Image header is incomplete")
+		tokens.extend(line.split(b'#', 1)[0].split())
+
+	(magic, width, height, max_value) = tokens
+	if magic not in (b'P5', b'P6') or int(max_value) > 255:
+		raise ValueError(f"Unsupported image format {magic.decode(errors='replace')} (max value {max_value.decode(errors='replace')})")
+	channels = 3 if magic == b'P6' else 1
+	data = await stream.readexactly(int(width) * int(height) * channels)
+	image = numpy.frombuffer(data, dtype=numpy.uint8).reshape(int(height), int(width), channels)
+	return image[:, :, 0] if channels == 1 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
 class PdfParser(AnswerParser):
 	EXTENSIONS = {'.pdf'}
 
+	# Amount of pages rasterized at once. Bounds memory usage independent of the page count
+	PAGE_WINDOW = 8
+	# Resolution pages are rasterized at
+	DPI = 200
+
 	pdfFile: Path
+	options: ParserOptions
+	cache: Optional[PageCache]
+
 	def __init__(self, args: list[str]) -> None:
 		super().__init__()
 		self.pdfFile = Path(args[0])
+		self.options = self.getOptions(args)
+		# In template mode, the result of a page also depends on the pages before it
+		self.cache = PageCache(self.options.cache, self.options.cache_size) if self.options.cache is not None and not self.options.template else None
+
+	def page_count(self) -> int:
+		return int(pdfinfo_from_path(self.pdfFile)["Pages"])
+
+	def pdf_to_images(self, pdf_file, first_page: Optional[int]=None, last_page: Optional[int]=None) -> list[Image]:
+		# Without output folder poppler writes to stdout and the pages are decoded straight from that buffer
+		images: list[Image] = convert_from_path(pdf_file,
+			dpi=self.DPI,
+			first_page=first_page,
+			last_page=last_page,
+			# Single channel pages, the parser only works on grayscale
+			grayscale=True,
+			fmt="ppm")
 
-	def pdf_to_png(self, pdf_file, output_folder) -> list[Path]:
-		# Seiten des PDFs in PNG-Bilder konvertieren
-		images: list[Path] = convert_from_path(pdf_file,
-			dpi=200,
-			output_folder=output_folder,
-			paths_only=True,
-			fmt="png")
-
-		#for i, image in enumerate(images):
-		#    image.save(f"{output_folder}/{i + 1}.png", "PNG")
-		
 		return images
-	
-	def extractAnswers(self) -> list[Student]:
-		with tempfile.TemporaryDirectory() as temp_directory:
-			png_paths = self.pdf_to_png(self.pdfFile, temp_directory)
 
-			result: list[Student] = []
+	def pdf_to_files(self, pdf_file, directory: Path, first_page: Optional[int]=None, last_page: Optional[int]=None) -> list[Path]:
+		""" Rasterizes pages into uncompressed PGM files in `directory`. Workers map them with `read_pgm()` """
+		paths: list[str] = convert_from_path(pdf_file,
+			dpi=self.DPI,
+			output_folder=directory,
+			first_page=first_page,
+			last_page=last_page,
+			grayscale=True,
+			fmt="ppm",
+			paths_only=True)
+
+		return [Path(path) for path in paths]
+
+	def rasterize(self, directory: Optional[str], first_page: int, last_page: int) -> list[Page]:
+		if directory is not None:
+			return self.pdf_to_files(self.pdfFile, Path(directory), first_page=first_page, last_page=last_page)
+		return self.pdf_to_images(self.pdfFile, first_page=first_page, last_page=last_page)
+
+	async def iter_images_async(self) -> AsyncIterator[numpy.ndarray]:
+		""" Rasterizes all pages in a poppler subprocess and yields every page (grayscale) as soon as poppler wrote it """
+		try:
+			process = await asyncio.create_subprocess_exec("pdftoppm", "-r", str(self.DPI), "-gray", str(self.pdfFile),
+				stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+		except FileNotFoundError as error:
+			raise ValueError("pdftoppm not found. Is poppler installed and in PATH?") from error
+		# Read at the same time, so poppler never blocks on a full stderr pipe
+		errors = asyncio.ensure_future(process.stderr.read())
+		try:
+			while (image := await read_pnm(process.stdout)) is not None:
+				yield image
+			if await process.wait() != 0:
+				message = (await errors).decode(errors='replace').strip()
+				raise ValueError(f"pdftoppm failed for '{self.pdfFile}': {message}")
+		finally:
+			if process.returncode is None:
+				process.kill()
+				await process.wait()
+			errors.cancel()
+
+	def worker_count(self, page_count: int) -> int:
+		return max(1, min(self.options.worker_count(), page_count))
+
+	def parse_images(self, images: list[Page], executor: Optional[Executor], parse=parse_page) -> Iterator[Any]:
+		pages = iter(images)
+		# Until a layout template was found, pages depend on their predecessors
+		while self.options.template and self.options.layout is None:
+			image = next(pages, None)
+			if image is None:
+				return
+			yield parse(image, self.options)
+
+		if executor is None:
+			yield from map(parse, pages, itertools.repeat(self.options))
+			return
+		# map() yields in submission order, so ids follow the page order
+		try:
+			if profiling.enabled():
+				for result, snapshot in executor.map(functools.partial(profile_call, parse), pages, itertools.repeat(self.options)):
+					profiling.merge(snapshot)
+					yield result
+			else:
+				yield from executor.map(parse, pages, itertools.repeat(self.options))
+		except BrokenProcessPool:
+			discard_executor(executor)
+			raise
+
+	def parse_pages(self, images: list[Page], executor: Optional[Executor], hashes: Optional[list[str]]=None) -> Iterator[numpy.ndarray]:
+		""" Codes of all `images`. Pages in the page cache are not parsed, `hashes` are the `image_hash()` of the images if known """
+		if self.cache is None:
+			yield from self.parse_images(images, executor)
+			return
+
+		settings = self.settings()
+		if hashes is None:
+			hashes = [image_hash(numpy.asarray(open_page(image))) for image in images]
+		known = [self.cache.load(hash, settings) for hash in hashes]
+		parsed = self.parse_images([image for image, arrays in zip(images, known) if arrays is None], executor, parse=parse_page_grid)
+
+		for hash, arrays in zip(hashes, known):
+			if arrays is None:
+				grid = next(parsed)
+				self.cache.save(hash, settings, vars(grid))
+			else:
+				grid = CheckGrid(**arrays)
+			yield grid.codes()
 
-			for idx, path in enumerate(png_paths):
-				#png_file :Path
-				#png_file = f"{temp_directory}/{i + 1}.png"
-				parser = PngParser(args=[path])
-				[ student ] = parser.extractAnswers()
-				student.id = idx + 1
-				result.append(student)
+	def settings(self) -> str:
+		""" Everything besides the pixels that changes the result of a page """
+		return f"pdf;dpi={self.DPI};template={self.options.template};png={PngParser.fingerprint()}"
 
-		return result
+	def parse_stored(self, images: list[Page], executor: Optional[Executor], store: ResultStore, page_hashes: list[str]) -> Iterator[numpy.ndarray]:
+		""" Like `parse_pages()`, but only parses pages missing in `store`. Appends the hash of every page to `page_hashes` """
+		settings = self.settings()
+		hashes = [image_hash(numpy.asarray(open_page(image))) for image in images]
+		known = [store.load_page(hash, settings) for hash in hashes]
+		missing = [(image, hash) for image, hash, codes in zip(images, hashes, known) if codes is None]
+		parsed = self.parse_pages([image for image, _ in missing], executor, [hash for _, hash in missing])
+
+		new_pages = []
+		for hash, codes in zip(hashes, known):
+			if codes is None:
+				codes = next(parsed)
+				new_pages.append((hash, codes))
+			page_hashes.append(hash)
+			yield codes
+		# Written at once, so the store isn't locked for other jobs while pages are parsed
+		for hash, codes in new_pages:
+			store.save_page(hash, settings, codes)
+		store.commit()
+
+	def iterAnswers(self) -> Iterator[Student]:
+		if self.options.store is None or self.options.template:
+			yield from self.iterParsed()
+			self.report_cache()
+			return
+
+		with ResultStore(self.options.store) as store:
+			settings = self.settings()
+			document = file_hash(self.pdfFile)
+			pages = store.load_document(document, settings)
+			if pages is not None:
+				# Unchanged file, not even rasterizing is needed
+				matrix = AnswerMatrix()
+				for page_id, codes in enumerate(pages, start=1):
+					profiling.count("pages")
+					yield matrix.append(page_id, codes)
+			else:
+				page_hashes: list[str] = []
+				yield from self.iterParsed(store, page_hashes)
+				store.save_document(document, settings, page_hashes)
+			print(f"Store: {store.hits} pages reused, {store.misses} pages parsed")
+		self.report_cache()
+
+	def report_cache(self):
+		if self.cache is not None:
+			print(f"Cache: {self.cache.hits} hits, {self.cache.misses} misses")
+
+	def iterParsed(self, store: Optional[ResultStore]=None, page_hashes: Optional[list[str]]=None) -> Iterator[Student]:
+		pages = self.page_count()
+		jobs = self.worker_count(pages)
+		# Every worker needs at least one page per window
+		window = max(self.PAGE_WINDOW, jobs)
+
+		# Other files processed at the same time use the same workers
+		executor = shared_executor(self.options.worker_count()) if jobs > 1 else None
+		# Pages are written straight into one matrix, the students are views on it
+		matrix = AnswerMatrix()
+		page_id = 0
+		for first_page in range(1, pages + 1, window):
+			last_page = min(first_page + window - 1, pages)
+			# The files of a window are removed once all its pages are parsed
+			raster_files = TemporaryDirectory(prefix="pdf_pages_", ignore_cleanup_errors=True) if self.options.raster_files else nullcontext()
+			with raster_files as directory:
+				with profiling.span("pdf.rasterize"):
+					images = self.rasterize(directory, first_page, last_page)
+
+				if store is not None:
+					parsed = self.parse_stored(images, executor, store, page_hashes)
+				else:
+					parsed = self.parse_pages(images, executor)
+
+				for codes in parsed:
+					page_id += 1
+					profiling.count("pages")
+					yield matrix.append(page_id, codes)
+
+	def extractAnswers(self) -> list[Student]:
+		return list(self.iterAnswers())
 
 AnswerParser.register(PdfParser)
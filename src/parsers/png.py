@@ -1,17 +1,20 @@
 from interfaces import AnswerParser
-from containers import Student, Answer
-from typing import Any, TypeAlias, Callable, TypeVar, Optional, Iterable
+from containers import Student, Answer, ParserOptions
+from store import PageCache, image_hash
+import profiling
+from typing import Any, TypeAlias, Optional
 from dataclasses import dataclass
 
 import cv2
 import cv2.typing
 import numpy
+import hashlib
 import itertools
+import math
+import threading
 from statistics import fmean
 
 cv2Img: TypeAlias = cv2.typing.MatLike
-T = TypeVar('T')
-Ty = TypeVar('Ty')
 
 @dataclass
 class CheckBox:
@@ -33,39 +36,154 @@ class CheckBox:
 	def area(self) -> int:
 		return self.w * self.h
 	
-	def copy(self, *, x: Optional[int]=None, y: Optional[int]=None, w: Optional[int]=None, h: Optional[int]=None) -> "CheckBox":
-		return CheckBox(
-			x=x or self.x,
-			y=y or self.y,
-			w=w or self.w,
-			h=h or self.h,
-			value=self.value,
-			score=self.score
-		)
-	
 CheckRow: TypeAlias = list[Optional[CheckBox]]
 
-def split_list(list: list[T], predicate: Callable[[T, T], bool]) -> list[list[T]]:
-	""" Splits a list based on a predicate between two elements """
-	if len(list) < 2:
-		return list
-	result = []
-	start_idx = 0
-	for idx, e in enumerate(list):
-		if idx == 0: continue # skip first element
-		if predicate(list[idx - 1], e):
-			# Split here
-			result.append(list[start_idx:idx])
-			start_idx = idx
-	
-	result.append(list[start_idx:])
-	return result
+@dataclass
+class CheckGrid:
+	"""
+	Struct of arrays of many checkboxes.
+	The boxes of question `i` are stored in the range `offsets[i]:offsets[i+1]`
+	"""
+	x: numpy.ndarray
+	y: numpy.ndarray
+	w: numpy.ndarray
+	h: numpy.ndarray
+	# ASCII codes of the box values, see `CheckBox.value`
+	value: numpy.ndarray
+	score: numpy.ndarray
+	offsets: numpy.ndarray
+
+	@classmethod
+	def from_boxes(cls, x: Any, y: Any, w: Any, h: Any, offsets: Optional[numpy.ndarray]=None) -> "CheckGrid":
+		""" Unclassified boxes. Without `offsets`, all boxes are in a single row """
+		count = len(x)
+		return cls(
+			x=numpy.asarray(x, dtype=numpy.int64),
+			y=numpy.asarray(y, dtype=numpy.int64),
+			w=numpy.asarray(w, dtype=numpy.int64),
+			h=numpy.asarray(h, dtype=numpy.int64),
+			value=numpy.full(count, ord('#'), dtype=numpy.uint8),
+			score=numpy.full(count, -1, dtype=numpy.int64),
+			offsets=offsets if offsets is not None else numpy.array([0, count])
+		)
+
+	@classmethod
+	def concat(cls, grids: list["CheckGrid"]) -> "CheckGrid":
+		if len(grids) == 0:
+			return cls.from_boxes([], [], [], [])
+		starts = numpy.cumsum([0] + [len(grid) for grid in grids[:-1]])
+		return cls(
+			x=numpy.concatenate([grid.x for grid in grids]),
+			y=numpy.concatenate([grid.y for grid in grids]),
+			w=numpy.concatenate([grid.w for grid in grids]),
+			h=numpy.concatenate([grid.h for grid in grids]),
+			value=numpy.concatenate([grid.value for grid in grids]),
+			score=numpy.concatenate([grid.score for grid in grids]),
+			offsets=numpy.concatenate([[0]] + [grid.offsets[1:] + start for grid, start in zip(grids, starts)])
+		)
+
+	def __len__(self) -> int:
+		return len(self.x)
+
+	@property
+	def row_count(self) -> int:
+		return len(self.offsets) - 1
+
+	def row_ids(self) -> numpy.ndarray:
+		""" Question index of every box """
+		return numpy.repeat(numpy.arange(self.row_count), numpy.diff(self.offsets))
+
+	def take(self, index: Any, offsets: Optional[numpy.ndarray]=None) -> "CheckGrid":
+		""" Selects boxes by index or mask. Without `offsets`, the result is a single row """
+		x = self.x[index]
+		return CheckGrid(
+			x=x,
+			y=self.y[index],
+			w=self.w[index],
+			h=self.h[index],
+			value=self.value[index],
+			score=self.score[index],
+			offsets=offsets if offsets is not None else numpy.array([0, len(x)])
+		)
+
+	def rows(self) -> list[CheckRow]:
+		""" CheckBox objects of every question, intended for debug output """
+		boxes = [CheckBox(*box) for box in zip(
+			self.x.tolist(), self.y.tolist(), self.w.tolist(), self.h.tolist(),
+			self.value.tobytes().decode('ascii'), self.score.tolist())]
+		return [boxes[start:end] for start, end in itertools.pairwise(self.offsets.tolist())]
+
+	def codes(self) -> numpy.ndarray:
+		""" Values as (questions, boxes) array of ASCII codes, padded with `0`. See `matrix.AnswerMatrix` """
+		lengths = numpy.diff(self.offsets)
+		codes = numpy.zeros((self.row_count, lengths.max(initial=0)), dtype=numpy.uint8)
+		row_ids = self.row_ids()
+		codes[row_ids, numpy.arange(len(self)) - self.offsets[row_ids]] = self.value
+		return codes
+
+	def options(self) -> list[str]:
+		""" Values of every question """
+		values = self.value.tobytes().decode('ascii')
+		return [values[start:end] for start, end in itertools.pairwise(self.offsets.tolist())]
+
+@dataclass
+class SheetLayout:
+	""" Checkbox grid of a clean sheet. All sheets of an exam share it, so it is detected only once """
+
+	# (left, top, right, bottom) of the answer region in page coordinates
+	frame: tuple[int, int, int, int]
+	# Checkboxes relative to the answer region
+	grid: CheckGrid
+
+	def register(self, frame: tuple[int, int, int, int]) -> CheckGrid:
+		""" Maps the grid onto a page whose answer region is located at `frame` """
+		(left, top, right, bottom) = self.frame
+		(page_left, page_top, page_right, page_bottom) = frame
+		scale_x = (page_right - page_left) / (right - left)
+		scale_y = (page_bottom - page_top) / (bottom - top)
+
+		return CheckGrid.from_boxes(
+			x=numpy.maximum(0, numpy.round(page_left + (self.grid.x - left) * scale_x)),
+			y=numpy.maximum(0, numpy.round(self.grid.y * scale_y)),
+			w=numpy.round(self.grid.w * scale_x),
+			h=numpy.round(self.grid.h * scale_y),
+			offsets=self.grid.offsets
+		)
 
-def find(iterable: Iterable[Ty], predicate: Callable[[Ty], bool]) -> Optional[Ty]:
-	for el in iterable:
-		if predicate(el):
-			return el
-	return None
+def split_bounds(values: numpy.ndarray, tolerance: float) -> numpy.ndarray:
+	""" Group boundaries of ordered `values`, split where neighbours differ by more than `tolerance` """
+	splits = numpy.flatnonzero(numpy.abs(numpy.diff(values)) > tolerance) + 1
+	return numpy.concatenate(([0], splits, [len(values)]))
+
+def box_sums(integral: numpy.ndarray, x: Any, y: Any, w: Any, h: Any) -> numpy.ndarray:
+	"""
+	Sums of many rectangles at once, read from an integral image (`cv2.integral`).
+	Rectangles are clipped to the image like slicing would
+	"""
+	height, width = integral.shape[0] - 1, integral.shape[1] - 1
+	x0 = numpy.clip(x, 0, width)
+	y0 = numpy.clip(y, 0, height)
+	x1 = numpy.clip(numpy.add(x, w), 0, width)
+	y1 = numpy.clip(numpy.add(y, h), 0, height)
+	return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+class Workspace(threading.local):
+	"""
+	Work buffers of the current thread, reused for every page the thread processes.
+	Images returned from a buffer stay valid until the next page of the same thread is processed
+	"""
+
+	def __init__(self) -> None:
+		self.buffers: dict[str, numpy.ndarray] = {}
+
+	def get(self, name: str, shape: tuple[int, ...], dtype: Any=numpy.uint8) -> numpy.ndarray:
+		size = math.prod(shape)
+		buffer = self.buffers.get(name)
+		if buffer is None or buffer.dtype != dtype or buffer.size < size:
+			buffer = numpy.empty(size, dtype=dtype)
+			self.buffers[name] = buffer
+		# A prefix of a flat buffer is always contiguous, OpenCV writes into it without reallocating
+		return buffer[:size].reshape(shape)
 
 class PngParser(AnswerParser):
 	EXTENSIONS = {'.png'}
@@ -81,6 +199,13 @@ class PngParser(AnswerParser):
 	# Length at which lines are concidered large. Used for detecting answer box region
 	# The size should be large enough to just catch frames and ignore/omit answer boxes/text/other small details
 	LARGE_LINE_SIZE = 100
+	# Length at which lines are concidered part of a checkbox
+	BOX_LINE_SIZE = 15
+
+	# The frame rectangles are searched in a page reduced by this factor first. 1 searches in full resolution only
+	FRAME_SEARCH_SCALE = 4
+	# Surrounding (in reduced pixels) of the frames found in the reduced page that is searched in full resolution
+	FRAME_SEARCH_MARGIN = 4
 
 	# FRAME RECTANGLES
 	
@@ -107,21 +232,19 @@ class PngParser(AnswerParser):
 	# Tolerance where boxes of different rows are concidered as "in the same answer column"
 	QUESTION_THRESHOLD = 10
 
-	# Thresholds for box and associated values. Values (low, high, value)
-	RATIOS = [
-		(0.00, 0.20, '#'),
-		(0.20, 0.27, 'o'),
-		(0.27, 0.38, 'O'),
-		(0.38, 0.43, 'o'),
-		(0.43, 0.48, 'x'),
-		(0.48, 0.60, 'X'),
-		(0.60, 0.65, 'x'),
-		(0.65, 0.75, 'o'),
-		(0.75, 1.10, 'O'),
-
-		# Catches holes in definition space. >1 because range check is truly less for upper border
-		(0.00, 1.10, '#'), 
+	# Minimal amount of diagonal stroke pixels for a box to be concidered crossed
+	CROSS_MIN_SCORE = 3
+
+	# Share of the box size cut off on every side when measuring the fill ratio, so the box lines don't count
+	FILL_MARGIN = 0.3
+	# Fill ratios that decide the value of a box right away. Values (low, high, value)
+	# Boxes outside of these ranges are analyzed for diagonal strokes and get the uncertain values 'x'/'o'
+	FILL_RATIOS = [
+		(0.00, 0.05, 'O'),
+		(0.30, 0.70, 'X'),
 	]
+	# Pixels around an uncertain box the diagonal analysis sees. Large enough for the box line kernels
+	BOX_CONTEXT_MARGIN = 24
 
 	# === DEBUG ===
 	
@@ -130,23 +253,90 @@ class PngParser(AnswerParser):
 
 	PREVIEW_WINDOW_SIZE = (600, 800)
 
+	# === STRUCTURING ELEMENTS ===
+
+	SMOOTH_KERNEL = numpy.ones((3, 3), numpy.uint8)
+	DIAGONAL_KERNEL = numpy.diag(numpy.ones(5, dtype=numpy.uint8))
+	ANTI_DIAGONAL_KERNEL = numpy.ascontiguousarray(numpy.fliplr(DIAGONAL_KERNEL))
+
+	# Horizontal and vertical line kernels by line length
+	LINE_KERNELS: dict[int, tuple[numpy.ndarray, numpy.ndarray]] = {}
 
-	def __init__(self, args: list[str]) -> None:
+	WORKSPACE = Workspace()
+
+	# Constants that don't change the results, left out of `fingerprint()`
+	FINGERPRINT_IGNORE = {'DEBUG_MESSAGE_MODE', 'PREVIEW_WINDOW_SIZE', 'LINE_KERNELS', 'WORKSPACE', 'FINGERPRINT_IGNORE'}
+
+	def __init__(self, args: list[Any]) -> None:
 		# For debug purposes
 		# 0 = all, 1 = important, 2 = none
 		self.show_priority_threshold = self.DEBUG_MESSAGE_MODE
-
-		self.image = cv2.imread(args[0])
-		self.image = cv2.resize(self.image, self.IMAGE_SIZE, interpolation=self.IMAGE_SCALE_METHOD)
-		
-		gray_img = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-		_, img = cv2.threshold(gray_img, self.BINARY_IMG_THRESHOLD, 255, cv2.THRESH_BINARY_INV)
-		self.binary_image = img
-
-		self.show_image("Grayscale Image", self.image, priority=0)
+		self.options = self.getOptions(args)
+
+		# args[0] is either a path or an already decoded BGR/grayscale image
+		if isinstance(args[0], numpy.ndarray):
+			image = args[0]
+		else:
+			with profiling.span("png.load"):
+				image = cv2.imread(str(args[0]), cv2.IMREAD_GRAYSCALE)
+
+		# Grid of this page from the page cache, or where to save it. Decoded pages are cached by their parser (`PdfParser`).
+		# In template mode, the result of a page also depends on the pages before it
+		self.cached_grid: Optional[CheckGrid] = None
+		self.cache_entry: Optional[tuple[PageCache, str, str]] = None
+		if self.options.cache is not None and not self.options.template and not isinstance(args[0], numpy.ndarray):
+			cache = PageCache(self.options.cache, self.options.cache_size)
+			(hash, settings) = (image_hash(image), f"png;{self.fingerprint()}")
+			if (arrays := cache.load(hash, settings)) is not None:
+				# Nothing else is needed, not even the debug images
+				self.cached_grid = CheckGrid(**arrays)
+				return
+			self.cache_entry = (cache, hash, settings)
+
+		with profiling.span("png.threshold"):
+			if image.ndim == 3:
+				# Nearest neighbour scaling commutes with the conversion, converting first scales a third of the data
+				image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+			# Only the single channel image is kept, see `image` for the color version used by the debug output
+			self.gray_image = cv2.resize(image, self.IMAGE_SIZE, interpolation=self.IMAGE_SCALE_METHOD)
+			_, img = cv2.threshold(self.gray_image, self.BINARY_IMG_THRESHOLD, 255, cv2.THRESH_BINARY_INV)
+			self.binary_image = img
+
+		self.show_image("Grayscale Image", self.gray_image, priority=0)
 		self.show_image("Binary Image", self.binary_image, priority=0)
 
-		self.image, self.binary_image = self.get_answer_box()
+		with profiling.span("png.find_answer_box"):
+			self.gray_image, self.binary_image = self.get_answer_box()
+		self.binary_integral: Optional[numpy.ndarray] = None
+
+	@property
+	def image(self) -> cv2Img:
+		""" Color copy of `gray_image` to draw debug output on. Created on every access """
+		return cv2.cvtColor(self.gray_image, cv2.COLOR_GRAY2BGR)
+
+	@classmethod
+	def fingerprint(cls) -> str:
+		""" Hash of all detection constants. Stored results are only valid for an equal fingerprint """
+		digest = hashlib.sha256()
+		for name in sorted(dir(cls)):
+			if not name.isupper() or name in cls.FINGERPRINT_IGNORE:
+				continue
+			value = getattr(cls, name)
+			if isinstance(value, numpy.ndarray):
+				value = (value.shape, value.tobytes())
+			digest.update(f"{name}={value!r};".encode())
+		return digest.hexdigest()
+
+	@classmethod
+	def from_image(cls, image: Any, options: Optional[ParserOptions]=None) -> "PngParser":
+		""" Creates a parser for an in-memory page. Accepts BGR/grayscale numpy arrays and PIL images """
+		if not isinstance(image, numpy.ndarray):
+			if image.mode == 'L':
+				image = numpy.asarray(image)
+			else:
+				# Same weights as `COLOR_BGR2GRAY`, PIL's own conversion rounds differently
+				image = cv2.cvtColor(numpy.asarray(image.convert('RGB')), cv2.COLOR_RGB2GRAY)
+		return cls([image, None, options])
 
 	def show_image(self, view_name, image, priority: int=2):
 		if priority >= self.show_priority_threshold:
@@ -156,52 +346,128 @@ class PngParser(AnswerParser):
 			cv2.waitKey(0)
 			cv2.destroyAllWindows()
 
-	def get_hv_img(self, binary_img: cv2Img, min_line_len: float) -> cv2Img:
-		kernel_h = numpy.ones((1, min_line_len), numpy.uint8)
-		kernel_v = numpy.ones((min_line_len, 1), numpy.uint8)
+	@classmethod
+	def line_kernels(cls, min_line_len: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+		if min_line_len not in cls.LINE_KERNELS:
+			cls.LINE_KERNELS[min_line_len] = (
+				numpy.ones((1, min_line_len), numpy.uint8),
+				numpy.ones((min_line_len, 1), numpy.uint8),
+			)
+		return cls.LINE_KERNELS[min_line_len]
 
-		img_h = cv2.morphologyEx(binary_img, cv2.MORPH_OPEN, kernel_h)
-		img_v = cv2.morphologyEx(binary_img, cv2.MORPH_OPEN, kernel_v)
+	def get_hv_img(self, binary_img: cv2Img, min_line_len: int, dst: Optional[cv2Img]=None) -> cv2Img:
+		kernel_h, kernel_v = self.line_kernels(min_line_len)
+
+		img_h = cv2.morphologyEx(binary_img, cv2.MORPH_OPEN, kernel_h, dst=self.WORKSPACE.get("lines_h", binary_img.shape))
+		img_v = cv2.morphologyEx(binary_img, cv2.MORPH_OPEN, kernel_v, dst=self.WORKSPACE.get("lines_v", binary_img.shape))
 		
 		self.show_image("H-Lines", img_h, priority=0)
 		self.show_image("V-Lines", img_v, priority=0)
 
-		return img_h | img_v
+		return cv2.bitwise_or(img_h, img_v, dst=dst)
 
-	def find_answer_box(self) -> CheckBox:
-		# Find region of image where answers are located
-		# 		
-		img = self.get_hv_img(self.binary_image, min_line_len=self.LARGE_LINE_SIZE)
+	def find_frames(self, binary_img: cv2Img, min_line_len: int, scale: int=1) -> tuple[Optional[numpy.ndarray], Optional[numpy.ndarray]]:
+		""" (x, y, w, h) of the top and bottom frame rectangle in `binary_img`, `scale` times smaller than the page """
+		img = self.get_hv_img(binary_img, min_line_len=min_line_len, dst=self.WORKSPACE.get("frame_lines", binary_img.shape))
 		self.show_image("Big Boxes", img)
-		_, _, stats, _ = cv2.connectedComponentsWithStats(img, connectivity=8)
+		labels = self.WORKSPACE.get("labels", img.shape, numpy.int32)
+		_, _, stats, _ = cv2.connectedComponentsWithStats(img, labels=labels, connectivity=8)
 
 		# We want the rectangle between rectangle A and B
 		# A is spanning vertically roughly half the page
 		# B is to the end of the page
 		# both span >80% of the width of the page
 
-		img_height, img_width = self.image.shape[:2]
+		img_height, img_width = img.shape[:2]
 
-		answer_top_y = None
-		answer_bottom_y = None
+		top_frame = None
+		bottom_frame = None
 
-		out_img = self.image.copy()
+		out_img = self.image if self.show_priority_threshold < 1 else None
 
 		for x, y, w, h, _area in stats[1:]:
 			if w > self.RECT_MIN_WIDTH * img_width:
-				if answer_top_y is None and y < self.TOP_RECT_START_Y * img_height and self.TOP_RECT_HEIGHT[0] <= h / img_height <= self.TOP_RECT_HEIGHT[1]:
-					answer_top_y = y + h
-				elif answer_bottom_y is None and y > self.BOTTOM_RECT_START_Y * img_height:
-					answer_bottom_y = y
+				if top_frame is None and self.is_top_frame(y, h, img_height):
+					top_frame = numpy.array([x, y, w, h])
+				elif bottom_frame is None and self.is_bottom_frame(y, img_height):
+					bottom_frame = numpy.array([x, y, w, h])
 
 				if self.show_priority_threshold < 1:
-					cv2.rectangle(out_img, (x, y), (x+w, y+h), (0, 0, 255), 2)
-
-		self.show_image("Big Boxes", out_img, priority=0)
-					
+					cv2.rectangle(out_img, (x * scale, y * scale), ((x+w) * scale, (y+h) * scale), (0, 0, 255), 2)
+
+		if out_img is not None:
+			self.show_image("Big Boxes", out_img, priority=0)
+
+		return top_frame, bottom_frame
+
+	def is_top_frame(self, y: int, h: int, img_height: int) -> bool:
+		return y < self.TOP_RECT_START_Y * img_height and self.TOP_RECT_HEIGHT[0] <= h / img_height <= self.TOP_RECT_HEIGHT[1]
+
+	def is_bottom_frame(self, y: int, img_height: int) -> bool:
+		return y > self.BOTTOM_RECT_START_Y * img_height
+
+	def find_frames_coarse(self) -> tuple[Optional[numpy.ndarray], Optional[numpy.ndarray]]:
+		"""
+		Like `find_frames()` on the whole page, but the frames are searched in a reduced copy of the page.
+		Only the surroundings of the frames found there are analyzed in full resolution
+		"""
+		scale = self.FRAME_SEARCH_SCALE
+		img_height, img_width = self.binary_image.shape[:2]
+
+		# Any set pixel keeps its block set, lines don't break up
+		small_img = cv2.resize(self.binary_image, (img_width // scale, img_height // scale), dst=self.WORKSPACE.get("frame_small", (img_height // scale, img_width // scale)), interpolation=cv2.INTER_AREA)
+		cv2.threshold(small_img, 0, 255, cv2.THRESH_BINARY, dst=small_img)
+		frames = self.find_frames(small_img, self.LARGE_LINE_SIZE // scale, scale=scale)
+		if frames[0] is None or frames[1] is None:
+			return None, None
+
+		refined = []
+		margin = self.FRAME_SEARCH_MARGIN * scale
+		for x, y, w, h in frames:
+			left, top = max(0, x * scale - margin), max(0, y * scale - margin)
+			right, bottom = min(img_width, (x + w) * scale + margin), min(img_height, (y + h) * scale + margin)
+			region = self.binary_image[top:bottom, left:right]
+
+			lines = self.get_hv_img(region, min_line_len=self.LARGE_LINE_SIZE, dst=self.WORKSPACE.get("frame_lines", region.shape))
+			labels = self.WORKSPACE.get("labels", region.shape, numpy.int32)
+			count, _, stats, _ = cv2.connectedComponentsWithStats(lines, labels=labels, connectivity=8)
+			if count < 2:
+				return None, None
+			# The frame is the widest line structure around its reduced counterpart
+			frame = stats[1 + numpy.argmax(stats[1:, cv2.CC_STAT_WIDTH]), :4].copy()
+			frame[:2] += (left, top)
+			refined.append(frame)
+
+		(top_frame, bottom_frame) = refined
+		# Frames that don't meet the criteria in full resolution are searched on the whole page again
+		if not (top_frame[2] > self.RECT_MIN_WIDTH * img_width and self.is_top_frame(top_frame[1], top_frame[3], img_height)):
+			return None, None
+		if not (bottom_frame[2] > self.RECT_MIN_WIDTH * img_width and self.is_bottom_frame(bottom_frame[1], img_height)):
+			return None, None
+		return top_frame, bottom_frame
 
-		assert answer_top_y is not None, "Top border not found"
-		assert answer_bottom_y is not None, "Bottom border not found"
+	def find_answer_box(self) -> CheckBox:
+		# Find region of image where answers are located
+		top_frame, bottom_frame = (None, None)
+		if self.FRAME_SEARCH_SCALE > 1:
+			top_frame, bottom_frame = self.find_frames_coarse()
+		if top_frame is None or bottom_frame is None:
+			top_frame, bottom_frame = self.find_frames(self.binary_image, self.LARGE_LINE_SIZE)
+
+		assert top_frame is not None, "Top border not found"
+		assert bottom_frame is not None, "Bottom border not found"
+
+		img_width = self.gray_image.shape[1]
+		answer_top_y = int(top_frame[1] + top_frame[3])
+		answer_bottom_y = int(bottom_frame[1])
+
+		# Horizontal extent of the frames, used to register the page against a layout template
+		self.answer_frame = (
+			round(fmean((int(top_frame[0]), int(bottom_frame[0])))),
+			answer_top_y,
+			round(fmean((int(top_frame[0] + top_frame[2]), int(bottom_frame[0] + bottom_frame[2])))),
+			answer_bottom_y,
+		)
 
 		return CheckBox(
 			x=0,
@@ -213,36 +479,64 @@ class PngParser(AnswerParser):
 	def get_answer_box(self) -> tuple[cv2Img, cv2Img]:
 		answer_box = self.find_answer_box()
 		if self.show_priority_threshold < 2:
-			img = self.image.copy()
+			img = self.image
 			cv2.rectangle(img, answer_box.top_left, answer_box.bottom_right, (0, 0, 255), 2)
 			self.show_image("Answer Box", img)
 		
 		(x_top, y_top) = answer_box.top_left
 		(x_bottom, y_bottom) = answer_box.bottom_right
 
-		cropped_img = self.image[y_top:y_bottom, x_top:x_bottom].copy()
-		cropped_binary_img = self.binary_image[y_top:y_bottom, x_top:x_bottom].copy()
+		# Views, the full page is not used afterwards
+		cropped_img = self.gray_image[y_top:y_bottom, x_top:x_bottom]
+		cropped_binary_img = self.binary_image[y_top:y_bottom, x_top:x_bottom]
 
 		return (cropped_img, cropped_binary_img)
 	
-	def get_checkboxes(self) -> list[CheckBox]:	
+	def get_box_lines(self, binary_img: Optional[cv2Img]=None) -> cv2Img:
+		if binary_img is None:
+			return self.get_hv_img(self.binary_image, min_line_len=self.BOX_LINE_SIZE, dst=self.WORKSPACE.get("box_lines", self.binary_image.shape))
+		return self.get_hv_img(binary_img, min_line_len=self.BOX_LINE_SIZE)
 
-		binary_hv_img = self.get_hv_img(self.binary_image, min_line_len=15)
+	def get_checkboxes(self) -> CheckGrid:	
+
+		binary_hv_img = self.get_box_lines()
 		self.show_image("Detected Boxes", binary_hv_img, priority=0)
-		_, _, stats, _ = cv2.connectedComponentsWithStats(binary_hv_img, connectivity=8)
+		labels = self.WORKSPACE.get("labels", binary_hv_img.shape, numpy.int32)
+		_, _, stats, _ = cv2.connectedComponentsWithStats(binary_hv_img, labels=labels, connectivity=8)
+
+		x, y, w, h = stats[1:, cv2.CC_STAT_LEFT], stats[1:, cv2.CC_STAT_TOP], stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+		ratio = w / h
+		is_square = (1 - self.SQUARE_TOLERANCE <= ratio) & (ratio <= 1 + self.SQUARE_TOLERANCE)
+
+		checkboxes = CheckGrid.from_boxes(x[is_square], y[is_square], w[is_square], h[is_square])
+		with profiling.span("png.classify_boxes"):
+			self.classify_boxes(checkboxes)
+		profiling.count("boxes.detected", len(checkboxes))
+		
+		return checkboxes
+
+	def get_class_image(self, binary_img: Optional[cv2Img]=None, box_lines: Optional[cv2Img]=None) -> cv2Img:
+		""" Returns an image containing only the diagonal strokes of crosses. Defaults to the whole answer box """
+		if binary_img is None:
+			binary_img = self.binary_image
+			if box_lines is None:
+				box_lines = self.get_box_lines()
+		elif box_lines is None:
+			box_lines = self.get_box_lines(binary_img)
+		shape = binary_img.shape
 
-		hv_img = self.get_hv_img(self.binary_image, 15)
 		# Smooth rough edges
-		hv_img = cv2.morphologyEx(hv_img, cv2.MORPH_DILATE, numpy.ones((3, 3)))
-		class_img = self.binary_image & ~hv_img
+		hv_img = cv2.dilate(box_lines, self.SMOOTH_KERNEL, dst=self.WORKSPACE.get("smooth_lines", shape))
+		hv_img = cv2.bitwise_not(hv_img, dst=hv_img)
+		class_img = cv2.bitwise_and(binary_img, hv_img, dst=self.WORKSPACE.get("strokes", shape))
 
 		# Close holes
-		class_img = cv2.morphologyEx(class_img, cv2.MORPH_CLOSE, numpy.ones((3, 3)))
-		self.show_image("Diagonals Only", class_img)
+		closed_img = cv2.morphologyEx(class_img, cv2.MORPH_CLOSE, self.SMOOTH_KERNEL, dst=self.WORKSPACE.get("closed", shape))
+		self.show_image("Diagonals Only", closed_img)
 		# Extract Diagonals tl--br
-		class_img_1 = cv2.morphologyEx(class_img, cv2.MORPH_ERODE, numpy.diag(numpy.ones(5, dtype=numpy.uint8)))
-		class_img_2 = cv2.morphologyEx(class_img, cv2.MORPH_ERODE, numpy.fliplr(numpy.diag(numpy.ones(5, dtype=numpy.uint8))))
-		class_img = class_img_1 | class_img_2
+		class_img_1 = cv2.erode(closed_img, self.DIAGONAL_KERNEL, dst=self.WORKSPACE.get("diagonals", shape))
+		class_img_2 = cv2.erode(closed_img, self.ANTI_DIAGONAL_KERNEL, dst=class_img)
+		class_img = cv2.bitwise_or(class_img_1, class_img_2, dst=class_img_1)
 		self.show_image("Filtered Diagonals", class_img)
 
 		# class_img = cv2.morphologyEx(class_img, cv2.MORPH_OPEN, numpy.ones((3, 3)))
@@ -260,15 +554,7 @@ class PngParser(AnswerParser):
 		# 		cv2.line(out_img, (x1, y1), (x2, y2), (0, 0, 255), 1)
 		# 	self.show_image("Detected Lines", out_img)
 
-		checkboxes = []
-		for x, y, w, h, _area in stats[1:]:
-			ratio = w / h
-			if 1 - self.SQUARE_TOLERANCE <= ratio <= 1 + self.SQUARE_TOLERANCE:
-				box = CheckBox(x, y, w, h)
-				box.value = self.classify_box(class_img, box)
-				checkboxes.append(box)
-		
-		return checkboxes
+		return class_img
 	
 	def normalized_angle(self, p1: tuple[int, int], p2: tuple[int, int]) -> float:
 		""" Returns angle of a line (defined by p1, p2) normalized to first quadrant (0..90deg) """
@@ -284,104 +570,228 @@ class PngParser(AnswerParser):
 			angle -= 90
 		return angle
 
-	def classify_box(self, img: cv2Img, box: CheckBox) -> str:
-		img = img[box.y:box.y+box.h , box.x:box.x+box.w]
-
-		box.score = cv2.countNonZero(img)
-
-		if box.score > 3:
-			return 'X'
-		return 'O'	
-
-	def answer_columns(self, questions: list[CheckBox], threshold: int) -> list[int]:
-		vertical_lines = [box.x for box in questions]
-		vertical_lines.sort()
-		vertical_lines = split_list(vertical_lines, lambda a, b: abs(a - b) > self.QUESTION_THRESHOLD)
-		vertical_lines = ((fmean(x_values), len(x_values)) for x_values in vertical_lines)
-
-		return [mean for mean, votes in vertical_lines if votes > threshold]
-
-	def count_white(self, image: cv2Img, box: CheckBox) -> int:
-		return cv2.countNonZero(image[box.y:box.y+box.h , box.x:box.x+box.w])
-
-	def extractAnswers(self) -> list[Student]:
-		# High level order of operations:
-		# I. Get Checkboxes
-		# II. Sort checkboxes and mark missing ones
-		# III. Evaluate checkboxes
-
-
-		# I. Get Checkboxes
-		checkboxes = self.get_checkboxes()
-
-
-		# II. Sort checkboxes and mark missing ones
+	def integral_image(self, image: cv2Img, name: str) -> numpy.ndarray:
+		height, width = image.shape[:2]
+		return cv2.integral(image, sum=self.WORKSPACE.get(name, (height + 1, width + 1), numpy.int32), sdepth=cv2.CV_32S)
+
+	def count_boxes(self, integral: numpy.ndarray, x: Any, y: Any, w: Any, h: Any) -> numpy.ndarray:
+		""" Counts white pixels of many boxes of a binary (0/255) image at once """
+		return box_sums(integral, x, y, w, h) // 255
+
+	def get_binary_integral(self) -> numpy.ndarray:
+		""" Integral image of the answer box, computed once per page """
+		if self.binary_integral is None:
+			self.binary_integral = self.integral_image(self.binary_image, "binary_integral")
+		return self.binary_integral
+
+	def classify_scores(self, scores: numpy.ndarray) -> numpy.ndarray:
+		""" Returns ASCII codes of the box values. Only boxes the fill ratio left undecided are scored, so they are 'x'/'o' """
+		return numpy.where(scores > self.CROSS_MIN_SCORE, ord('x'), ord('o')).astype(numpy.uint8)
+
+	def classify_ratios(self, ratios: numpy.ndarray) -> numpy.ndarray:
+		""" Looks up the values (ASCII codes) of fill ratios in `FILL_RATIOS`. The first matching range wins, otherwise '#' """
+		values = numpy.full(ratios.shape, ord('#'), dtype=numpy.uint8)
+		unassigned = numpy.ones(ratios.shape, dtype=bool)
+		for low, high, value in self.FILL_RATIOS:
+			match = unassigned & (low <= ratios) & (ratios < high)
+			values[match] = ord(value)
+			unassigned &= ~match
+		return values
+
+	def fill_ratios(self, boxes: CheckGrid) -> numpy.ndarray:
+		""" Share of black pixels inside of every box, without its lines. See `FILL_MARGIN` """
+		margin_x = (boxes.w * self.FILL_MARGIN).astype(numpy.int64)
+		margin_y = (boxes.h * self.FILL_MARGIN).astype(numpy.int64)
+		w = numpy.maximum(boxes.w - 2 * margin_x, 1)
+		h = numpy.maximum(boxes.h - 2 * margin_y, 1)
+		return self.count_boxes(self.get_binary_integral(), boxes.x + margin_x, boxes.y + margin_y, w, h) / (w * h)
+
+	def score_boxes(self, boxes: CheckGrid, index: numpy.ndarray) -> numpy.ndarray:
+		""" Diagonal stroke pixels of the selected boxes, each analyzed in a small region around the box """
+		margin = self.BOX_CONTEXT_MARGIN
+		(height, width) = self.binary_image.shape[:2]
+		scores = numpy.zeros(len(index), dtype=numpy.int64)
+		for i, (x, y, w, h) in enumerate(zip(boxes.x[index].tolist(), boxes.y[index].tolist(), boxes.w[index].tolist(), boxes.h[index].tolist())):
+			left, top = max(x - margin, 0), max(y - margin, 0)
+			region = self.binary_image[top:min(y + h + margin, height), left:min(x + w + margin, width)]
+			class_img = self.get_class_image(region)
+			scores[i] = cv2.countNonZero(class_img[y - top:y - top + h, x - left:x - left + w])
+		return scores
+
+	def classify_boxes(self, boxes: CheckGrid):
+		"""
+		Classifies all boxes in two tiers. The fill ratio decides most boxes (see `FILL_RATIOS`),
+		only the remaining ones are analyzed for diagonal strokes and get the uncertain values 'x'/'o'
+		"""
+		boxes.value = self.classify_ratios(self.fill_ratios(boxes))
+		boxes.score = numpy.full(len(boxes), -1, dtype=numpy.int64)
+
+		uncertain = numpy.flatnonzero(boxes.value == ord('#'))
+		scores = self.score_boxes(boxes, uncertain)
+		boxes.score[uncertain] = scores
+		boxes.value[uncertain] = self.classify_scores(scores)
+		profiling.count("boxes.uncertain", len(uncertain))
+
+	def answer_columns(self, x: numpy.ndarray, threshold: int) -> numpy.ndarray:
+		vertical_lines = numpy.sort(x)
+		bounds = split_bounds(vertical_lines, self.QUESTION_THRESHOLD)
+		votes = numpy.diff(bounds)
+		means = numpy.add.reduceat(vertical_lines, bounds[:-1]) / votes
+
+		return means[votes > threshold]
+
+	def group_checkboxes(self, checkboxes: CheckGrid) -> CheckGrid:
+		""" Sorts checkboxes into questions and inserts boxes that were not detected """
 
-		# TODO : Sort checkboxes into groups
 		# Idea:
 		# 1. Order by x-level
 		# 2. Split where significant jump occures
 		# 3. Order rows by y-level
 		# 4. Split where prev-to-current jump is too high
-		# 5. Find if we have missing boxes and insert *None* to indicate so
+		# 5. Find if we have missing boxes and insert boxes marked '#' to indicate so
 
-		# TODO : Filter false-positive boxes
+		# Filter false-positive boxes
 		# - Numbers: Define vertical lines, every box that doesnt fall on one gets removed
 		# - Letters: Left to the leftmost box, there has to be a number (aka *some* black pixels)
 
+		if len(checkboxes) == 0:
+			return checkboxes
 
 		# 1. Order by x-level
-		checkboxes.sort(key=lambda box: box.x)
+		checkboxes = checkboxes.take(numpy.argsort(checkboxes.x, kind='stable'))
 		# 2. Split where significant jump occures
-		checkbox_columns = split_list(checkboxes, lambda a, b: abs(a.x - b.x) > self.X_TOLERANCE)
+		column_bounds = split_bounds(checkboxes.x, self.X_TOLERANCE)
+
+		answers: list[CheckGrid] = []
+		binary_integral = self.get_binary_integral()
 
-		answers: list[CheckRow] = []
+		for start, end in itertools.pairwise(column_bounds.tolist()):
+			column = checkboxes.take(slice(start, end))
 
-		for idx, column in enumerate(checkbox_columns):
 			# Filter falsely detected boxes in numbers column
-			vertical_lines = self.answer_columns(column, threshold=10)
-			column = [box for box in column if any(abs(box.x - line) < self.QUESTION_THRESHOLD for line in vertical_lines)]
+			vertical_lines = self.answer_columns(column.x, threshold=10)
+			column = column.take(self.line_distances(column.x, vertical_lines).any(axis=1))
 			# 3. Order rows by y-level
-			column.sort(key=lambda box: box.y)
+			column = column.take(numpy.argsort(column.y, kind='stable'))
 			# 4. Split where prev-to-current jump is too high
-			questions = split_list(column, lambda a, b: abs(a.y - b.y) > self.Y_TOLERANCE)
+			column.offsets = split_bounds(column.y, self.Y_TOLERANCE)
 
 			# Filter falsely detected boxes in letter row
-			box_width = int(fmean(box.w for box in column))
-			box_height = int(fmean(box.h for box in column))
-			numbers_column = int(min(vertical_lines))
-			numbers_box = CheckBox(
-				x=numbers_column - 2 * box_width - 5,
-				y=-1, # will be set later
-				w=box_width * 2,
-				h=box_height
-			)
-			questions = [question for question in questions if self.count_white(self.binary_image, numbers_box.copy(y=question[0].y)) > 0]
+			box_width = int(column.w.mean())
+			box_height = int(column.h.mean())
+			numbers_column = int(vertical_lines.min())
+			numbers_x = numbers_column - 2 * box_width - 5
+			numbers_white = self.count_boxes(binary_integral, numbers_x, column.y[column.offsets[:-1]], box_width * 2, box_height)
+			is_question = numbers_white > 0
+
+			# Keep questions and order their boxes by x-level
+			row_ids = column.row_ids()
+			order = numpy.flatnonzero(is_question[row_ids])
+			order = order[numpy.argsort(column.x[order], kind='stable')]
+			order = order[numpy.argsort(row_ids[order], kind='stable')]
+			lengths = numpy.diff(column.offsets)[is_question]
+			column = column.take(order, offsets=numpy.concatenate(([0], numpy.cumsum(lengths))))
+
+			# 5. Mark missing boxes
+			answers.append(self.insert_missing(column, vertical_lines))
+
+		return CheckGrid.concat(answers)
+
+	def line_distances(self, x: numpy.ndarray, vertical_lines: numpy.ndarray) -> numpy.ndarray:
+		""" Matrix (box, answer column) of whether a box lies on an answer column """
+		return numpy.abs(x[:, numpy.newaxis] - vertical_lines[numpy.newaxis, :]) < self.QUESTION_THRESHOLD
+
+	def insert_missing(self, column: CheckGrid, vertical_lines: numpy.ndarray) -> CheckGrid:
+		""" Fills questions with fewer boxes than answer columns with boxes marked '#' """
+		line_count = len(vertical_lines)
+		lengths = numpy.diff(column.offsets)
+		is_short = lengths < line_count
+		if not is_short.any():
+			return column
+
+		out_lengths = numpy.where(is_short, line_count, lengths)
+		out_offsets = numpy.concatenate(([0], numpy.cumsum(out_lengths)))
+		profiling.count("boxes.inserted", int(out_offsets[-1]) - len(column))
+		out_rows = numpy.repeat(numpy.arange(column.row_count), out_lengths)
+		slot = numpy.arange(len(out_rows)) - out_offsets[out_rows]
+
+		# Inserted boxes sit on their answer column and take y-level and size from the first box of the question
+		first_box = column.offsets[:-1][out_rows]
+		result = CheckGrid.from_boxes(
+			x=vertical_lines.astype(numpy.int64)[numpy.minimum(slot, line_count - 1)],
+			y=column.y[first_box],
+			w=column.w[first_box],
+			h=column.h[first_box],
+			offsets=out_offsets
+		)
+
+		# Detected boxes of short questions move to the first answer column they lie on, others keep their place
+		row_ids = column.row_ids()
+		position = numpy.arange(len(column)) - column.offsets[row_ids]
+		matching_line = numpy.argmax(self.line_distances(column.x, vertical_lines), axis=1)
+		target = out_offsets[row_ids] + numpy.where(is_short[row_ids], matching_line, position)
+
+		result.x[target] = column.x
+		result.y[target] = column.y
+		result.w[target] = column.w
+		result.h[target] = column.h
+		result.value[target] = column.value
+		result.score[target] = column.score
+		return result
+
+	def get_layout(self, answers: CheckGrid) -> Optional[SheetLayout]:
+		""" Returns the grid of this sheet if it is clean enough to serve as template """
+		lengths = numpy.diff(answers.offsets)
+		if len(answers) == 0 or (lengths != lengths[0]).any():
+			return None
+		# Inserted boxes keep their '#' value
+		if (answers.value == ord('#')).any():
+			return None
+
+		grid = CheckGrid.from_boxes(answers.x, answers.y, answers.w, answers.h, offsets=answers.offsets)
+		return SheetLayout(frame=self.answer_frame, grid=grid)
+
+	def extractAnswers(self) -> list[Student]:
+		student = Student(0) # Id needs to be set by caller
+		student.answers = [Answer(options=options) for options in self.extractGrid().options()]
+		return [student]
+
+	def extractCodes(self) -> numpy.ndarray:
+		""" Answers as (questions, boxes) array of ASCII codes, ready to be written into an `AnswerMatrix` """
+		return self.extractGrid().codes()
 
-			v_lines = [(x_value, idx) for idx, x_value in enumerate(vertical_lines)]
+	def extractGrid(self) -> CheckGrid:
+		if self.cached_grid is not None:
+			return self.cached_grid
 
-			for q in questions:
-				q.sort(key=lambda box: box.x)
+		# High level order of operations:
+		# I. Get Checkboxes
+		# II. Sort checkboxes and mark missing ones
+		# III. Evaluate checkboxes
+
+		layout: Optional[SheetLayout] = self.options.layout if self.options.template else None
+		if layout is not None:
+			# I. + II. The grid is known, only the boxes have to be located on this page
+			answers = layout.register(self.answer_frame)
+			with profiling.span("png.classify_boxes"):
+				self.classify_boxes(answers)
+		else:
+			# I. Get Checkboxes
+			with profiling.span("png.get_checkboxes"):
+				checkboxes = self.get_checkboxes()
 
-				if len(q) < len(vertical_lines):
-					# Mark missing boxes
-					y_level, box_w, box_h = q[0].y, q[0].w, q[0].h
-					
-					missing_lines = v_lines.copy()
-					for box in q:
-						matching_line = find(v_lines, lambda tpl: abs(tpl[0] - box.x) < self.QUESTION_THRESHOLD)
-						if matching_line is not None:
-							missing_lines.remove(matching_line)
-					for x_level, idx in missing_lines:
-						q.insert(idx, CheckBox(int(x_level), y_level, box_w, box_h))
+			# II. Sort checkboxes and mark missing ones
+			with profiling.span("png.group_checkboxes"):
+				answers = self.group_checkboxes(checkboxes)
 
-			answers.extend(questions)
+			if self.options.template:
+				self.options.layout = self.get_layout(answers)
 
 		# Debug Display routine
 		# Color boxes that are in same question similar
 		if self.show_priority_threshold <= 3:
-			img = self.image.copy()
-			for idx, answer in enumerate(answers):
+			img = self.image
+			for idx, answer in enumerate(answers.rows()):
 				hue = 25 * idx % 180
 				for idx2, box in enumerate(a for a in answer if a is not None):
 					val = abs(255 - idx2 * 50) % 256
@@ -394,21 +804,16 @@ class PngParser(AnswerParser):
 			self.show_image("Grouped Answers", img, priority=3)
 			self.show_image("Grouped Binary", self.binary_image, priority=3)
 
-		# III. Evaluate checkboxes
-
-		student = Student(0) # Id needs to be set by caller
+		# III. Evaluate checkboxes (done by the caller)
 
-		for answer in answers:
-			options = ""
-			for box in answer:
-				if box is None:
-					options += '#'
-				else:
-					options += box.value
-					
-			student.answers.append(Answer(options=options))
-		
-		return [student]
+		profiling.count("pages.parsed")
+		if profiling.enabled():
+			# Answers with at least one box that could not be detected reliably
+			profiling.count("answers.missing", int((answers.codes() == ord('#')).any(axis=1).sum()))
+		if self.cache_entry is not None:
+			(cache, hash, settings) = self.cache_entry
+			cache.save(hash, settings, vars(answers))
+		return answers
 
 AnswerParser.register(PngParser)
 
@@ -0,0 +1,244 @@
+"""
+Pipeline that overlaps rasterization, page analysis and loading into SQLite, driven by asyncio.
+
+- PDF pages are read from a poppler subprocess while poppler renders the next ones
+- Pages are analyzed in the worker processes (`-j`), or in one thread
+- Analyzed sheets are inserted into the `results` table in batches as they arrive, in page order
+
+Queues between the stages are bounded, so rasterization waits when the analysis falls behind
+"""
+from analysis.sql import SqlAnalyzer
+from containers import Student, ParserOptions, StatisticsBook, StatisticsSheet, SheetCombiner
+from matrix import AnswerMatrix
+from parsers import get_parser_result
+from parsers.png import PngParser
+from pathlib import Path
+from typing import Any, Optional, Union
+from concurrent.futures import Executor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import aclosing, closing
+import asyncio
+import functools
+import sqlite3
+import time
+
+import numpy
+import profiling
+
+# Marks the end of a file in the page queue and the end of a parse worker in the result queue
+END = None
+
+def parse_source(source: Union[Path, numpy.ndarray], options: Optional[ParserOptions]=None) -> numpy.ndarray:
+	""" Codes of a page, given as image file or as decoded grayscale image """
+	return PngParser([source, None, options]).extractCodes()
+
+class Pipeline:
+	# Pages waiting for analysis per worker. Bounds the memory used by rasterized pages
+	QUEUE_PAGES = 2
+	# Sheets inserted into sqlite at once
+	BATCH_SIZE = 64
+
+	files: list[Path]
+	answer_count: int
+	options: ParserOptions
+	nerd: Optional[Student]
+	combiner: SheetCombiner
+
+	def __init__(self, files: list[Path], answer_count: int, options: ParserOptions, nerd: Optional[Student]=None,
+			sql_path: Optional[Path]=None, database: Optional[Path]=None, stream: bool=False) -> None:
+		self.files = [Path(file) for file in files]
+		self.answer_count = answer_count
+		self.options = options
+		self.nerd = nerd
+		# Without queries, the sheets are only collected
+		self.sql_path = sql_path
+		self.database = database
+		self.stream = stream
+		self.combiner = SheetCombiner(nerd.id if nerd is not None else None)
+		# Sheets of PDF and PNG pages are views on this matrix
+		self.matrix = AnswerMatrix()
+		self.analyzer: Optional[SqlAnalyzer] = None
+		self.conn: Optional[sqlite3.Connection] = None
+
+	@property
+	def students(self) -> list[Student]:
+		return self.combiner.students
+
+	@property
+	def sources(self) -> StatisticsSheet:
+		return self.combiner.sources
+
+	def run(self) -> Optional[StatisticsBook]:
+		""" Parses all files and, with `sql_path`, runs the queries. Returns `None` without `sql_path` """
+		return asyncio.run(self.run_async())
+
+	async def run_async(self) -> Optional[StatisticsBook]:
+		workers = self.options.worker_count()
+		if workers > 1:
+			from parsers.pdf import shared_executor
+			executor: Executor = shared_executor(workers)
+		else:
+			# Keeps the event loop free to read poppler's output while a page is analyzed
+			executor = ThreadPoolExecutor(max_workers=1)
+
+		pages: asyncio.Queue = asyncio.Queue(maxsize=self.QUEUE_PAGES * workers)
+		results: asyncio.Queue = asyncio.Queue(maxsize=self.QUEUE_PAGES * workers)
+		# Until a layout template was found, pages depend on their predecessors
+		template_lock = asyncio.Lock()
+
+		try:
+			tasks = [
+				asyncio.create_task(self.produce(pages, workers)),
+				*(asyncio.create_task(self.parse(pages, results, executor, template_lock)) for _ in range(workers)),
+				asyncio.create_task(self.load(results, workers)),
+			]
+			try:
+				await asyncio.gather(*tasks)
+			except BaseException:
+				for task in tasks:
+					task.cancel()
+				await asyncio.gather(*tasks, return_exceptions=True)
+				if self.conn is not None:
+					self.conn.close()
+				raise
+		finally:
+			if workers == 1:
+				executor.shutdown()
+
+		if self.sql_path is None:
+			return None
+		if self.analyzer is None:
+			raise ValueError("No sheets found in the given files")
+		with closing(self.conn):
+			with profiling.span("sql.load"):
+				self.analyzer.create_correctness(self.conn)
+				self.conn.commit()
+			return self.analyzer.execute_sql(self.conn)
+
+	async def produce(self, pages: asyncio.Queue, workers: int):
+		""" Puts every page of every file into `pages` as (sequence, file, id, page), followed by `END` of the file """
+		sequence = 0
+		for file_index, file in enumerate(self.files):
+			suffix = file.suffix.casefold()
+			if suffix == '.pdf':
+				from parsers.pdf import PdfParser
+				parser = PdfParser([file, str(self.answer_count), self.options])
+				async with aclosing(parser.iter_images_async()) as images:
+					# Ids are the page numbers, like `PdfParser` assigns them
+					page_id = 0
+					async for image in images:
+						page_id += 1
+						await pages.put((sequence, file_index, page_id, image))
+						sequence += 1
+			elif suffix == '.png':
+				await pages.put((sequence, file_index, 0, file))
+				sequence += 1
+			else:
+				# Other formats are parsed as a whole
+				students = await asyncio.to_thread(get_parser_result, [file, str(self.answer_count), self.options])
+				if students is None:
+					raise ValueError(f"No parser for '{file}'")
+				await pages.put((sequence, file_index, None, students))
+				sequence += 1
+			await pages.put((sequence, file_index, None, END))
+			sequence += 1
+
+		for _ in range(workers):
+			await pages.put(END)
+
+	async def parse(self, pages: asyncio.Queue, results: asyncio.Queue, executor: Executor, template_lock: asyncio.Lock):
+		""" Analyzes pages from `pages` and puts (sequence, file, id, codes or students) into `results` """
+		while (item := await pages.get()) is not END:
+			(sequence, file_index, page_id, page) = item
+			if page is END or isinstance(page, list):
+				await results.put(item)
+				continue
+
+			codes = None
+			if self.options.template and self.options.layout is None:
+				async with template_lock:
+					if self.options.layout is None:
+						# The layout is set on `options` of this process, so it is searched in a thread
+						codes = await asyncio.to_thread(parse_source, page, self.options)
+			if codes is None:
+				codes = await self.analyze(page, executor)
+			await results.put((sequence, file_index, page_id, codes))
+		await results.put(END)
+
+	async def analyze(self, page: Union[Path, numpy.ndarray], executor: Executor) -> numpy.ndarray:
+		loop = asyncio.get_running_loop()
+		try:
+			if profiling.enabled() and not isinstance(executor, ThreadPoolExecutor):
+				from parsers.pdf import profile_call
+				codes, snapshot = await loop.run_in_executor(executor, functools.partial(profile_call, parse_source, page, self.options))
+				profiling.merge(snapshot)
+				return codes
+			return await loop.run_in_executor(executor, parse_source, page, self.options)
+		except BrokenProcessPool:
+			from parsers.pdf import discard_executor
+			discard_executor(executor)
+			raise
+
+	async def load(self, results: asyncio.Queue, workers: int):
+		""" Takes the results in page order and inserts them in batches. Ids are combined like `combineSheets()` does """
+		pending: dict[int, tuple[int, Optional[int], Any]] = {}
+		next_sequence = 0
+		batch: list[Student] = []
+
+		file_sheets = 0
+		sheet_count = 0
+		done = 0
+		start = time.perf_counter()
+
+		running = workers
+		while running > 0:
+			item = await results.get()
+			if item is END:
+				running -= 1
+				continue
+			(sequence, file_index, page_id, result) = item
+			pending[sequence] = (file_index, page_id, result)
+
+			while next_sequence in pending:
+				(file_index, page_id, result) = pending.pop(next_sequence)
+				next_sequence += 1
+				file = self.files[file_index]
+
+				if result is END:
+					done += 1
+					elapsed = time.perf_counter() - start
+					print(f"[{done}/{len(self.files)}] {file}: {file_sheets} sheets ({sheet_count / elapsed:.1f} sheets/s)")
+					self.combiner.end_file()
+					file_sheets = 0
+					continue
+
+				if isinstance(result, list):
+					students = result
+				else:
+					profiling.count("pages")
+					students = [self.matrix.append(page_id, result)]
+				self.combiner.add(file, students)
+				file_sheets += len(students)
+				sheet_count += len(students)
+
+				batch.extend(students)
+				if len(batch) >= self.BATCH_SIZE:
+					self.insert(batch)
+					batch = []
+
+		if len(batch) > 0:
+			self.insert(batch)
+
+	def insert(self, students: list[Student]):
+		""" Inserts a batch of students. The tables are created with the first batch, once the amount of boxes is known """
+		if self.sql_path is None:
+			return
+		with profiling.span("sql.load"):
+			if self.analyzer is None:
+				self.analyzer = SqlAnalyzer(self.students, nerd=self.nerd, sql_path=self.sql_path,
+					jobs=self.options.jobs, database=self.database, stream=self.stream)
+				self.conn = self.analyzer.create_connection()
+				self.analyzer.create_table(self.conn)
+				if self.nerd is not None:
+					self.analyzer.insert_students(self.conn, [self.nerd])
+			self.analyzer.insert_students(self.conn, students)
@@ -1,7 +1,9 @@
 
 from interfaces import FilePrinter
-import printers.csv
-import printers.excel
+
+# Printer modules are only imported once a file of their type is written
+FilePrinter.register({'.csv'}, 'printers.csv')
+FilePrinter.register({'.xlsx', '.xls'}, 'printers.excel')
 
 from pathlib import Path
 from containers import StatisticsBook
@@ -12,6 +12,7 @@ class CsvPrinter(FilePrinter):
 
 			with open(self.filePath.with_name(sheet_filename), 'w', newline='', encoding='utf-8') as csvfile:
 				csv_writer = csv.writer(csvfile, delimiter=',')
+				# Rows may be streamed, every row is written as soon as it is available
 				for row in sheet_data:
 					csv_writer.writerow(row.values)
 
@@ -8,8 +8,9 @@ class ExcelPrinter(FilePrinter):
 		workbook = Workbook()
 		for sheet in self.statBook.sheets:
 			worksheet = workbook.create_sheet(title=sheet.name)
-			for row in sheet.rows:
-				worksheet.append(row.values)
+			# Numbers are written as numeric cells if the sheet knows them
+			for values in sheet.values():
+				worksheet.append(values)
 		
 		workbook.remove(workbook.active)    
 		workbook.save(self.filePath)
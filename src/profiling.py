@@ -0,0 +1,114 @@
+"""
+Lightweight timing spans and counters.
+
+Disabled by default. Then `span()` returns a shared no-op context manager and `count()` returns
+right away, so instrumented code costs one function call and one check.
+"""
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Any, Optional
+import csv
+import json
+import threading
+import time
+
+class Profile:
+	""" Accumulated spans (count, total seconds) and counters """
+
+	def __init__(self) -> None:
+		self.spans: dict[str, list[float]] = {}
+		self.counters: dict[str, int] = {}
+		self.lock = threading.Lock()
+
+	def add_span(self, name: str, seconds: float, count: int=1):
+		with self.lock:
+			span = self.spans.setdefault(name, [0, 0.0])
+			span[0] += count
+			span[1] += seconds
+
+	def add_count(self, name: str, amount: int):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def snapshot(self) -> dict[str, Any]:
+		with self.lock:
+			return {
+				"spans": {name: {"count": int(count), "seconds": seconds} for name, (count, seconds) in self.spans.items()},
+				"counters": dict(self.counters),
+			}
+
+	def merge(self, snapshot: dict[str, Any]):
+		""" Adds the results of another process, see `snapshot()` """
+		for name, span in snapshot["spans"].items():
+			self.add_span(name, span["seconds"], span["count"])
+		for name, amount in snapshot["counters"].items():
+			self.add_count(name, amount)
+
+class Span:
+	__slots__ = ('name', 'count', 'start')
+
+	def __init__(self, name: str, count: int=1) -> None:
+		self.name = name
+		self.count = count
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		if PROFILE is not None:
+			PROFILE.add_span(self.name, time.perf_counter() - self.start, self.count)
+
+PROFILE: Optional[Profile] = None
+NO_SPAN = nullcontext()
+
+def enable():
+	global PROFILE
+	if PROFILE is None:
+		PROFILE = Profile()
+
+def reset():
+	""" Drops everything recorded so far, e.g. what a forked worker process inherited from its parent """
+	global PROFILE
+	PROFILE = None
+
+def enabled() -> bool:
+	return PROFILE is not None
+
+def span(name: str, count: int=1):
+	""" Context manager that records the time spent inside under `name`. With `count=0` the time is added to the last recorded span """
+	if PROFILE is None:
+		return NO_SPAN
+	return Span(name, count)
+
+def count(name: str, amount: int=1):
+	if PROFILE is None:
+		return
+	PROFILE.add_count(name, amount)
+
+def collect() -> dict[str, Any]:
+	""" Returns and resets the results of this process. Used to send results of worker processes back """
+	global PROFILE
+	snapshot = PROFILE.snapshot() if PROFILE is not None else {"spans": {}, "counters": {}}
+	PROFILE = Profile()
+	return snapshot
+
+def merge(snapshot: dict[str, Any]):
+	if PROFILE is not None:
+		PROFILE.merge(snapshot)
+
+def write(path: Path):
+	""" Writes the results as `.json`, otherwise as `.csv` with one row per span and counter """
+	path = Path(path)
+	snapshot = PROFILE.snapshot() if PROFILE is not None else {"spans": {}, "counters": {}}
+	if path.suffix.casefold() == '.json':
+		path.write_text(json.dumps(snapshot, indent=2), encoding='utf-8')
+		return
+
+	with open(path, 'w', newline='', encoding='utf-8') as csvfile:
+		csv_writer = csv.writer(csvfile, delimiter=',')
+		csv_writer.writerow(["kind", "name", "count", "seconds"])
+		for name, span in sorted(snapshot["spans"].items()):
+			csv_writer.writerow(["span", name, span["count"], span["seconds"]])
+		for name, amount in sorted(snapshot["counters"].items()):
+			csv_writer.writerow(["counter", name, amount, ""])
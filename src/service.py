@@ -0,0 +1,149 @@
+from containers import StatisticsBook
+from parsers import find_sheets
+from printers import get_printer
+from pathlib import Path
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import json
+import os
+import time
+
+class WatchService:
+	"""
+	Watches an inbox directory and analyzes every sheet file that lands there.
+
+	A file is picked up once its size and modification time did not change between two polls,
+	i.e. the scanner finished writing it. Every job writes its output and a status file
+	(`<output>_<file>.status.json`) next to `output`. Files that were already analyzed in their
+	current state are skipped, also after a restart. Failed files are tried again after a restart,
+	jobs that failed because a worker process died are queued again right away.
+	"""
+
+	# Attempts of a job whose worker process died, before it counts as failed
+	MAX_ATTEMPTS = 3
+
+	inbox: Path
+	output: Path
+	process: Callable[[Path], StatisticsBook]
+	interval: float
+	max_queue: int
+
+	def __init__(self, inbox: Path, output: Path, process: Callable[[Path], StatisticsBook], workers: int=1, interval: float=1.0, max_queue: int=16) -> None:
+		self.inbox = Path(inbox)
+		self.output = Path(output)
+		self.process = process
+		self.interval = interval
+		# Backpressure: files beyond this amount stay in the inbox until jobs finished
+		self.max_queue = max_queue
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.jobs: dict[Path, Future] = {}
+		# Size and modification time of every file at the previous poll
+		self.seen: dict[Path, tuple[int, int]] = {}
+		# Files that failed in their current state, not tried again until a restart
+		self.failed: dict[Path, tuple[int, int]] = {}
+		# Jobs of every file that failed because a worker process died
+		self.attempts: dict[Path, int] = {}
+
+	def job_name(self, file: Path) -> str:
+		# With the suffix, like `sheet_names()` tells files apart. x.pdf and x.png may both land in the inbox
+		return f"{self.output.stem}_{file.stem}_{file.suffix.lstrip('.')}"
+
+	def output_path(self, file: Path) -> Path:
+		return self.output.with_name(f"{self.job_name(file)}{self.output.suffix}")
+
+	def status_path(self, file: Path) -> Path:
+		return self.output.with_name(f"{self.job_name(file)}.status.json")
+
+	def signature(self, file: Path) -> Optional[tuple[int, int]]:
+		try:
+			stat = file.stat()
+		except FileNotFoundError:
+			return None
+		return (stat.st_size, stat.st_mtime_ns)
+
+	def read_status(self, file: Path) -> dict:
+		try:
+			return json.loads(self.status_path(file).read_text(encoding='utf-8'))
+		except (FileNotFoundError, ValueError):
+			return {}
+
+	def write_status(self, file: Path, **status):
+		path = self.status_path(file)
+		data = self.read_status(file) | status
+		# Readers never see a partially written status
+		temp_path = path.with_name(path.name + ".tmp")
+		temp_path.write_text(json.dumps(data, indent=2), encoding='utf-8')
+		os.replace(temp_path, path)
+
+	def is_done(self, file: Path, signature: tuple[int, int]) -> bool:
+		status = self.read_status(file)
+		return status.get("state") == "done" and status.get("signature") == list(signature)
+
+	def poll(self):
+		""" Queues every file that is complete and was not analyzed in its current state """
+		for file, job in list(self.jobs.items()):
+			if job.done():
+				del self.jobs[file]
+
+		waiting = 0
+		for file in find_sheets([str(self.inbox)]):
+			signature = self.signature(file)
+			previous = self.seen.get(file)
+			self.seen[file] = signature
+			if signature is None or signature != previous or file in self.jobs or self.failed.get(file) == signature or self.is_done(file, signature):
+				continue
+			if len(self.jobs) >= self.max_queue:
+				waiting += 1
+				continue
+			self.write_status(file, source=str(file), state="queued", signature=list(signature), queued=now(), error=None)
+			self.jobs[file] = self.executor.submit(self.run, file, signature)
+
+		if waiting > 0:
+			print(f"Queue full ({len(self.jobs)} jobs), {waiting} files waiting")
+
+	def run(self, file: Path, signature: tuple[int, int]):
+		start = time.perf_counter()
+		self.write_status(file, state="running", started=now())
+		try:
+			book = self.process(file)
+			output = self.output_path(file)
+			printer = get_printer(output, book=book)
+			printer.printStatistics()
+		except BrokenProcessPool as error:
+			# Not caused by the file, the next poll queues it again with a new pool
+			self.attempts[file] = self.attempts.get(file, 0) + 1
+			if self.attempts[file] < self.MAX_ATTEMPTS:
+				self.write_status(file, state="queued", error=repr(error))
+				print(f"{file}: worker process died, trying again")
+				return
+			self.fail(file, signature, error)
+			return
+		except Exception as error:
+			self.fail(file, signature, error)
+			return
+		self.attempts.pop(file, None)
+		self.write_status(file, state="done", finished=now(), output=str(output), seconds=time.perf_counter() - start)
+		print(f"{file}: done in {time.perf_counter() - start:.2f}s")
+
+	def fail(self, file: Path, signature: tuple[int, int], error: Exception):
+		self.failed[file] = signature
+		self.attempts.pop(file, None)
+		self.write_status(file, state="failed", finished=now(), error=repr(error))
+		print(f"{file}: failed ({error!r})")
+
+	def serve(self):
+		""" Polls the inbox until interrupted """
+		print(f"Watching {self.inbox}")
+		try:
+			while True:
+				self.poll()
+				time.sleep(self.interval)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.executor.shutdown(wait=True, cancel_futures=True)
+
+def now() -> str:
+	return datetime.now().isoformat(timespec='seconds')
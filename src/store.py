@@ -0,0 +1,197 @@
+from pathlib import Path
+from typing import Iterable, Optional
+
+import hashlib
+import os
+import sqlite3
+import threading
+import zipfile
+import numpy
+
+class ResultStore:
+	"""
+	On-disk record of parsed pages, so unchanged pages don't have to be parsed again.
+
+	- `pages(hash, settings, questions, boxes, codes)` contains the answer codes (see `matrix.encode()`) of every page
+	  by the hash of its pixels and the parser settings used
+	- `documents(hash, settings, page, page_hash)` contains the pages of every parsed file by the hash of the file.
+	  Unchanged files don't even have to be rasterized
+	"""
+
+	connection: sqlite3.Connection
+	hits: int
+	misses: int
+
+	def __init__(self, path: Path) -> None:
+		self.connection = sqlite3.connect(Path(path))
+		self.hits = 0
+		self.misses = 0
+		self.connection.execute("CREATE TABLE IF NOT EXISTS pages(hash TEXT, settings TEXT, questions INTEGER, boxes INTEGER, codes BLOB, PRIMARY KEY(hash, settings))")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS documents(hash TEXT, settings TEXT, page INTEGER, page_hash TEXT, PRIMARY KEY(hash, settings, page))")
+		self.connection.commit()
+
+	def __enter__(self) -> "ResultStore":
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		self.connection.commit()
+		self.connection.close()
+
+	def commit(self):
+		self.connection.commit()
+
+	def load_page(self, hash: str, settings: str) -> Optional[numpy.ndarray]:
+		row = self.connection.execute("SELECT questions, boxes, codes FROM pages WHERE hash = ? AND settings = ?", (hash, settings)).fetchone()
+		if row is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		(questions, boxes, codes) = row
+		return numpy.frombuffer(codes, dtype=numpy.uint8).reshape(questions, boxes)
+
+	def save_page(self, hash: str, settings: str, codes: numpy.ndarray):
+		(questions, boxes) = codes.shape
+		self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+			(hash, settings, questions, boxes, numpy.ascontiguousarray(codes, dtype=numpy.uint8).tobytes()))
+
+	def load_document(self, hash: str, settings: str) -> Optional[list[numpy.ndarray]]:
+		""" Returns the codes of all pages of a file, if every page is known """
+		page_hashes = self.connection.execute(
+			"SELECT page_hash FROM documents WHERE hash = ? AND settings = ? ORDER BY page", (hash, settings)).fetchall()
+		if len(page_hashes) == 0:
+			return None
+
+		pages = []
+		for (page_hash,) in page_hashes:
+			codes = self.load_page(page_hash, settings)
+			if codes is None:
+				return None
+			pages.append(codes)
+		return pages
+
+	def save_document(self, hash: str, settings: str, page_hashes: Iterable[str]):
+		self.connection.execute("DELETE FROM documents WHERE hash = ? AND settings = ?", (hash, settings))
+		self.connection.executemany("INSERT INTO documents VALUES (?, ?, ?, ?)",
+			((hash, settings, page, page_hash) for page, page_hash in enumerate(page_hashes, start=1)))
+		self.connection.commit()
+
+def file_hash(path: Path) -> str:
+	digest = hashlib.sha256()
+	with open(path, 'rb') as file:
+		while chunk := file.read(1 << 20):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def image_hash(image: numpy.ndarray) -> str:
+	""" Hash of the pixels of an image. Equal pages rasterize to equal pixels """
+	digest = hashlib.sha256()
+	digest.update(repr((image.shape, image.dtype.str)).encode())
+	digest.update(numpy.ascontiguousarray(image).data)
+	return digest.hexdigest()
+
+class PageCache:
+	"""
+	Directory of parse results (as arrays) by page content, shared by all runs and all files.
+
+	Entries are addressed by the hash of the page pixels and the parser settings.
+	When the directory grows beyond `max_size` bytes, the least recently used entries are removed
+	until it is down to `EVICT_TO` of `max_size`
+	"""
+
+	# Share of `max_size` eviction stops at, so the directory is not scanned again for every new entry
+	EVICT_TO = 0.9
+
+	# Size of every directory in use, shared by all caches of this process. The directory is scanned only once
+	SIZES: dict[Path, int] = {}
+	LOCK = threading.Lock()
+	# Hits and misses of all caches of this process
+	TOTAL_HITS = 0
+	TOTAL_MISSES = 0
+
+	directory: Path
+	max_size: int
+	hits: int
+	misses: int
+
+	def __init__(self, directory: Path, max_size: int) -> None:
+		self.directory = Path(directory).resolve()
+		self.directory.mkdir(parents=True, exist_ok=True)
+		self.max_size = max_size
+		with self.LOCK:
+			if self.directory not in self.SIZES:
+				self.SIZES[self.directory] = sum(entry.stat().st_size for entry in self.entries())
+		self.hits = 0
+		self.misses = 0
+
+	@property
+	def size(self) -> int:
+		return self.SIZES[self.directory]
+
+	def entries(self) -> list[Path]:
+		return [entry for entry in self.directory.glob('*/*.npz') if entry.is_file()]
+
+	def path(self, hash: str, settings: str) -> Path:
+		key = hashlib.sha256(f"{hash};{settings}".encode()).hexdigest()
+		return self.directory / key[:2] / f"{key}.npz"
+
+	def load(self, hash: str, settings: str) -> Optional[dict[str, numpy.ndarray]]:
+		path = self.path(hash, settings)
+		try:
+			with numpy.load(path) as entry:
+				arrays = {name: entry[name] for name in entry.files}
+		except (OSError, ValueError, zipfile.BadZipFile):
+			# Missing, or written only partially by an interrupted run
+			self.misses += 1
+			with self.LOCK:
+				PageCache.TOTAL_MISSES += 1
+			return None
+
+		# The modification time marks the last use
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			pass # Evicted by another process in the meantime
+		self.hits += 1
+		with self.LOCK:
+			PageCache.TOTAL_HITS += 1
+		return arrays
+
+	def save(self, hash: str, settings: str, arrays: dict[str, numpy.ndarray]):
+		path = self.path(hash, settings)
+		path.parent.mkdir(exist_ok=True)
+		# Other processes never see a partially written entry
+		temp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+		with open(temp_path, 'wb') as file:
+			numpy.savez(file, **arrays)
+		size = temp_path.stat().st_size
+
+		with self.LOCK:
+			# A replaced entry (e.g. a page saved twice) only counts once
+			try:
+				replaced = path.stat().st_size
+			except FileNotFoundError:
+				replaced = 0
+			os.replace(temp_path, path)
+			self.SIZES[self.directory] += size - replaced
+			if self.SIZES[self.directory] > self.max_size:
+				self.evict()
+
+	def evict(self):
+		""" Removes the least recently used entries until the cache fits into `EVICT_TO` of `max_size`. Called with `LOCK` held """
+		entries = []
+		for entry in self.entries():
+			try:
+				entries.append((entry.stat(), entry))
+			except FileNotFoundError:
+				pass # Removed by another process
+
+		size = sum(stat.st_size for stat, _ in entries)
+		for stat, entry in sorted(entries, key=lambda item: item[0].st_mtime):
+			if size <= self.max_size * self.EVICT_TO:
+				break
+			entry.unlink(missing_ok=True)
+			size -= stat.st_size
+		self.SIZES[self.directory] = size
@@ -1 +1,109 @@
+"""
+Checks of the pure logic that needs no sheets or poppler. Run with `python src/tests.py`
+"""
+from containers import Answer, Student, SheetCombiner
+from interfaces import AnswerParser, LazyPlugin
+from matrix import AnswerMatrix, encode
+from pathlib import Path
+from tempfile import TemporaryDirectory
 
+import numpy
+
+def sheet(id: int, *options: str) -> Student:
+	return Student(id, answers=[Answer(option) for option in options])
+
+def ids(students) -> list[int]:
+	return [student.id for student in students]
+
+def test_combiner_moves_png_off_solution():
+	# PNG sheets have id 0, like the default `--solution-id`
+	combiner = SheetCombiner(solution_id=0)
+	combiner.add(Path("a.png"), [sheet(0, "XO")])
+	combiner.end_file()
+	combiner.add(Path("b.png"), [sheet(0, "OX")])
+	combiner.end_file()
+	assert ids(combiner.students) == [1, 2]
+	assert [row.values for row in combiner.sources.rows] == [["id", "source"], ["1", "a.png"], ["2", "b.png"]]
+
+def test_combiner_moves_later_files_behind():
+	combiner = SheetCombiner()
+	combiner.add(Path("a.pdf"), [sheet(1, "XO"), sheet(2, "XO"), sheet(3, "XO")])
+	combiner.end_file()
+	combiner.add(Path("b.pdf"), [sheet(1, "XO"), sheet(2, "XO")])
+	combiner.end_file()
+	# Ids that don't overlap stay
+	combiner.add(Path("c.csv"), [sheet(10, "XO")])
+	combiner.end_file()
+	assert ids(combiner.students) == [1, 2, 3, 4, 5, 10]
+
+def test_combiner_skips_solution_within_file():
+	combiner = SheetCombiner(solution_id=5)
+	# Pages of one file may arrive in several batches, like in the pipeline
+	combiner.add(Path("a.pdf"), [sheet(1, "XO"), sheet(2, "XO"), sheet(3, "XO")])
+	combiner.add(Path("a.pdf"), [sheet(4, "XO"), sheet(5, "XO"), sheet(6, "XO")])
+	combiner.end_file()
+	combiner.add(Path("b.pdf"), [sheet(1, "XO")])
+	combiner.end_file()
+	assert ids(combiner.students) == [1, 2, 3, 4, 6, 7, 8]
+
+def test_matrix_round_trip():
+	students = [sheet(3, "XOO", "OxO#"), sheet(7, "O")]
+	matrix = AnswerMatrix.from_students(students)
+	assert len(matrix) == 2
+	assert ids(matrix) == [3, 7]
+	assert [[answer.options for answer in student.answers] for student in matrix] == [["XOO", "OxO#"], ["O"]]
+	assert matrix.question_counts().tolist() == [2, 1]
+	assert matrix.selected()[0].sum() == 2
+	assert matrix.has_missing().tolist() == [True, False]
+
+def test_matrix_views_write_through():
+	matrix = AnswerMatrix()
+	for id in range(5):
+		matrix.append(id, encode(["XO"]))
+	student = matrix[-1]
+	student.id = 42
+	student.answers[0].options = "OOOX"
+	assert matrix.ids[4] == 42
+	assert matrix.codes.shape[2] >= 4
+	assert matrix[4].answers[0].options == "OOOX"
+	assert matrix[0].answers[0].options == "XO"
+
+def test_read_pgm():
+	# `parsers.pdf` needs pdf2image
+	try:
+		from parsers.pdf import read_pgm
+	except ImportError:
+		return
+	pixels = numpy.arange(12, dtype=numpy.uint8).reshape(3, 4)
+	with TemporaryDirectory() as directory:
+		path = Path(directory) / "page.pgm"
+		path.write_bytes(b"P5\n# comment\n4 3\n255\n" + pixels.tobytes())
+		image = read_pgm(path)
+		assert numpy.array_equal(image, pixels)
+		del image
+
+		path.write_bytes(b"P6\n4 3\n255\n" + bytes(36))
+		try:
+			read_pgm(path)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError("P6 accepted")
+
+def test_lazy_plugin():
+	plugin = LazyPlugin({'.PNG'}, 'parsers.png')
+	assert plugin.matches("sheet.png") and not plugin.matches("sheet.pdf")
+	registry = [plugin]
+	plugin.load(registry)
+	assert registry == []
+	# Found without a file to open
+	assert AnswerParser.isSupported([Path("x.csv")])
+	assert not AnswerParser.isSupported([Path("x.txt")])
+	assert AnswerParser.findParser([Path("x.csv")]).__name__ == "CsvParser"
+
+
+if __name__ == "__main__":
+	for name, check in list(globals().items()):
+		if name.startswith("test_"):
+			check()
+			print(f"{name}: ok")